@@ -9,15 +9,18 @@ It can also make use of the global route planner to follow a specifed route
 """
 
 import carla
+import numpy as np
 
 from agents.navigation.local_planner import LocalPlanner
 from agents.navigation.global_route_planner import GlobalRoutePlanner
 from agents.tools.misc import (
     get_speed,
     is_within_distance,
-    get_trafficlight_trigger_location,
     get_acceleration,
+    forward_vectors,
+    is_within_distance_batch,
 )
+from agents.tools.world_cache import get_world_cache, get_waypoint_cache
 
 
 class BasicAgent(object):
@@ -40,6 +43,8 @@ class BasicAgent(object):
         self._vehicle = vehicle
         self._world = self._vehicle.get_world()
         self._map = self._world.get_map()
+        self._world_cache = get_world_cache(self._world)
+        self._world_cache.get_traffic_light_index(self._map)
         self._last_traffic_light = None
 
         # Base parameters
@@ -69,6 +74,13 @@ class BasicAgent(object):
         if 'max_brake' in opt_dict:
             self._max_steering = opt_dict['max_brake']
 
+        # Waypoint lookups are memoized on a grid of this resolution (meters)
+        self._waypoint_cache = get_waypoint_cache(
+            self._map,
+            resolution=opt_dict.get('waypoint_cache_resolution', 0.1),
+            max_size=opt_dict.get('waypoint_cache_size', 100000),
+        )
+
         # Initialize the planners
         self._local_planner = LocalPlanner(self._vehicle, opt_dict=opt_dict)
         self._global_planner = GlobalRoutePlanner(self._map, self._sampling_resolution)
@@ -96,8 +108,7 @@ class BasicAgent(object):
         return vehicle_data
 
     def get_traffic_data(self):
-        actor_list = self._world.get_actors()
-        lights_list = actor_list.filter("*traffic_light*")
+        lights_list = self._world_cache.update().traffic_lights.actors
         vehicle_speed = get_speed(self._vehicle) / 3.6
 
         # Check for possible traffic light
@@ -173,8 +184,8 @@ class BasicAgent(object):
             start_location = self._vehicle.get_location()
             clean_queue = False
 
-        start_waypoint = self._map.get_waypoint(start_location)
-        end_waypoint = self._map.get_waypoint(end_location)
+        start_waypoint = self._waypoint_cache.get_waypoint(start_location)
+        end_waypoint = self._waypoint_cache.get_waypoint(end_location)
 
         route_trace = self.trace_route(start_waypoint, end_waypoint)
         self._local_planner.set_global_plan(route_trace, clean_queue=clean_queue)
@@ -207,9 +218,9 @@ class BasicAgent(object):
         hazard_detected = False
 
         # Retrieve all relevant actors
-        actor_list = self._world.get_actors()
-        vehicle_list = actor_list.filter("*vehicle*")
-        lights_list = actor_list.filter("*traffic_light*")
+        world_cache = self._world_cache.update()
+        vehicle_list = world_cache.vehicles.actors
+        lights_list = world_cache.traffic_lights.actors
 
         vehicle_speed = get_speed(self._vehicle) / 3.6
 
@@ -264,7 +275,7 @@ class BasicAgent(object):
             return (False, None)
 
         if not lights_list:
-            lights_list = self._world.get_actors().filter("*traffic_light*")
+            lights_list = self._world_cache.update().traffic_lights.actors
 
         if not max_distance:
             max_distance = self._base_tlight_threshold
@@ -276,18 +287,21 @@ class BasicAgent(object):
                 return (True, self._last_traffic_light)
 
         ego_vehicle_location = self._vehicle.get_location()
-        ego_vehicle_waypoint = self._map.get_waypoint(ego_vehicle_location)
+        ego_vehicle_waypoint = self._waypoint_cache.get_waypoint(ego_vehicle_location)
 
-        for traffic_light in lights_list:
-            object_location = get_trafficlight_trigger_location(traffic_light)
-            object_waypoint = self._map.get_waypoint(object_location)
+        # Only the lights whose trigger is on the ego's road can affect it
+        traffic_light_index = self._world_cache.get_traffic_light_index(self._map)
+        lights_ids = {traffic_light.id for traffic_light in lights_list}
+        ve_dir = ego_vehicle_waypoint.transform.get_forward_vector()
 
-            if object_waypoint.road_id != ego_vehicle_waypoint.road_id:
+        for traffic_light in traffic_light_index.on_road(ego_vehicle_waypoint.road_id):
+            if traffic_light.id not in lights_ids:
                 continue
 
-            ve_dir = ego_vehicle_waypoint.transform.get_forward_vector()
-            wp_dir = object_waypoint.transform.get_forward_vector()
-            dot_ve_wp = ve_dir.x * wp_dir.x + ve_dir.y * wp_dir.y + ve_dir.z * wp_dir.z
+            object_waypoint, _, wp_dir = traffic_light_index.get_trigger(traffic_light)
+            dot_ve_wp = (
+                ve_dir.x * wp_dir[0] + ve_dir.y * wp_dir[1] + ve_dir.z * wp_dir[2]
+            )
 
             if dot_ve_wp < 0:
                 continue
@@ -319,13 +333,13 @@ class BasicAgent(object):
             return (False, None)
 
         if not vehicle_list:
-            vehicle_list = self._world.get_actors().filter("*vehicle*")
+            vehicle_list = self._world_cache.update().vehicles.actors
 
         if not max_distance:
             max_distance = self._base_vehicle_threshold
 
         ego_transform = self._vehicle.get_transform()
-        ego_wpt = self._map.get_waypoint(self._vehicle.get_location())
+        ego_wpt = self._waypoint_cache.get_waypoint(self._vehicle.get_location())
 
         # Get the transform of the front of the ego
         ego_forward_vector = ego_transform.get_forward_vector()
@@ -336,9 +350,22 @@ class BasicAgent(object):
             y=ego_extent * ego_forward_vector.y,
         )
 
-        for target_vehicle in vehicle_list:
-            target_transform = target_vehicle.get_transform()
-            target_wpt = self._map.get_waypoint(target_transform.location)
+        # Distance and angle checks of the rear of all the vehicles at once
+        locations, yaw, extents = self._world_cache.get_state(vehicle_list)
+        target_rear = locations[:, :2] - extents[:, :1] * forward_vectors(yaw)
+        within = is_within_distance_batch(
+            target_rear,
+            [ego_front_transform.location.x, ego_front_transform.location.y],
+            [ego_forward_vector.x, ego_forward_vector.y],
+            max_distance,
+            [0, 90],
+        )
+
+        # Lane checks only for the vehicles close enough, in the original order
+        for index in np.flatnonzero(within):
+            target_vehicle = vehicle_list[index]
+            target_location = carla.Location(*locations[index])
+            target_wpt = self._waypoint_cache.get_waypoint(target_location)
             if (
                 target_wpt.road_id != ego_wpt.road_id
                 or target_wpt.lane_id != ego_wpt.lane_id
@@ -354,16 +381,5 @@ class BasicAgent(object):
                 ):
                     continue
 
-            target_forward_vector = target_transform.get_forward_vector()
-            target_extent = target_vehicle.bounding_box.extent.x
-            target_rear_transform = target_transform
-            target_rear_transform.location -= carla.Location(
-                x=target_extent * target_forward_vector.x,
-                y=target_extent * target_forward_vector.y,
-            )
-
-            if is_within_distance(
-                target_rear_transform, ego_front_transform, max_distance, [0, 90]
-            ):
-                return (True, target_vehicle)
+            return (True, target_vehicle)
         return (False, None)
@@ -13,7 +13,12 @@ from agents.navigation.basic_agent import BasicAgent
 from agents.navigation.local_planner import RoadOption
 from agents.navigation.behavior_types import Cautious, Aggressive, Normal
 
-from agents.tools.misc import get_speed, positive, is_within_distance, compute_distance
+from agents.tools.misc import (
+    get_speed,
+    positive,
+    compute_distance,
+    is_within_distance_batch,
+)
 
 
 class BehaviorAgent(BasicAgent):
@@ -115,19 +120,30 @@ class BehaviorAgent(BasicAgent):
         """
         ego_transform = self._vehicle.get_transform()
         ego_location = ego_transform.location
-        ego_wpt = self._map.get_waypoint(ego_location)
+        ego_wpt = self._waypoint_cache.get_waypoint(ego_location)
 
         # Get the right offset
         if ego_wpt.lane_id < 0 and lane_offset != 0:
             lane_offset *= -1
 
-        for target_vehicle in vehicle_list:
+        # Distance and angle checks of all the targets at once
+        locations, _, _ = self._world_cache.get_state(vehicle_list)
+        ego_forward_vector = ego_transform.get_forward_vector()
+        within = is_within_distance_batch(
+            locations[:, :2],
+            [ego_location.x, ego_location.y],
+            [ego_forward_vector.x, ego_forward_vector.y],
+            proximity_th,
+            [low_angle_th, up_angle_th],
+        )
 
-            target_transform = target_vehicle.get_transform()
-            target_location = target_transform.location
-            # If the object is not in our next or current lane it's not an obstacle
+        # Lane checks only for the targets close enough, in the original order
+        for index in np.flatnonzero(within):
+            target_vehicle = vehicle_list[index]
+            target_location = carla.Location(*locations[index])
 
-            target_wpt = self._map.get_waypoint(target_location)
+            # If the object is not in our next or current lane it's not an obstacle
+            target_wpt = self._waypoint_cache.get_waypoint(target_location)
             if (
                 target_wpt.road_id != ego_wpt.road_id
                 or target_wpt.lane_id != ego_wpt.lane_id + lane_offset
@@ -141,27 +157,24 @@ class BehaviorAgent(BasicAgent):
                 ):
                     continue
 
-            if is_within_distance(
-                target_transform,
-                ego_transform,
-                proximity_th,
-                [low_angle_th, up_angle_th],
-            ):
-
-                return (
-                    True,
-                    target_vehicle,
-                    compute_distance(target_location, ego_location),
-                )
+            return (
+                True,
+                target_vehicle,
+                compute_distance(target_location, ego_location),
+            )
 
         return (False, None, -1)
 
+    def _distance_to(self, actor_group, location):
+        """Distances from all the actors of a cached group to a location"""
+        location = np.array([location.x, location.y, location.z])
+        return np.linalg.norm(actor_group.locations - location, axis=1)
+
     def traffic_light_manager(self):
         """
         This method is in charge of behaviors for red lights.
         """
-        actor_list = self._world.get_actors()
-        lights_list = actor_list.filter("*traffic_light*")
+        lights_list = self._world_cache.update().traffic_lights.actors
         affected, _ = self._affected_by_traffic_light(lights_list)
 
         return affected
@@ -240,13 +253,12 @@ class BehaviorAgent(BasicAgent):
             :return distance: distance to nearby vehicle
         """
 
-        vehicle_list = self._world.get_actors().filter("*vehicle*")
-
-        def dist(v):
-            return v.get_location().distance(waypoint.transform.location)
-
+        vehicles = self._world_cache.update().vehicles
+        distance = self._distance_to(vehicles, waypoint.transform.location)
         vehicle_list = [
-            v for v in vehicle_list if dist(v) < 45 and v.id != self._vehicle.id
+            v
+            for v, d in zip(vehicles.actors, distance)
+            if d < 45 and v.id != self._vehicle.id
         ]
 
         if self._direction == RoadOption.CHANGELANELEFT:
@@ -294,12 +306,9 @@ class BehaviorAgent(BasicAgent):
             :return distance: distance to nearby walker
         """
 
-        walker_list = self._world.get_actors().filter("*walker.pedestrian*")
-
-        def dist(w):
-            return w.get_location().distance(waypoint.transform.location)
-
-        walker_list = [w for w in walker_list if dist(w) < 10]
+        walkers = self._world_cache.update().walkers
+        distance = self._distance_to(walkers, waypoint.transform.location)
+        walker_list = [w for w, d in zip(walkers.actors, distance) if d < 10]
 
         if self._direction == RoadOption.CHANGELANELEFT:
             walker_state, walker, distance = self._vehicle_obstacle_detected(
@@ -390,7 +399,7 @@ class BehaviorAgent(BasicAgent):
             self._behavior.tailgate_counter -= 1
 
         ego_vehicle_loc = self._vehicle.get_location()
-        ego_vehicle_wp = self._map.get_waypoint(ego_vehicle_loc)
+        ego_vehicle_wp = self._waypoint_cache.get_waypoint(ego_vehicle_loc)
 
         # 1: Red lights and stops behavior
         if self.traffic_light_manager():
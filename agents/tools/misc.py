@@ -125,6 +125,64 @@ def is_within_distance(
     return min_angle < angle < max_angle
 
 
+def forward_vectors(yaw):
+    """
+    Returns the (N, 2) unit forward vectors of an array of yaw angles
+
+        :param yaw: (N,) array of yaw angles in degrees
+    """
+    yaw = np.radians(yaw)
+    return np.stack([np.cos(yaw), np.sin(yaw)], axis=-1)
+
+
+def compute_distances_and_angles(target_locations, reference_location, forward):
+    """
+    Computes the distances and angles of many target locations at once, with the
+    same definitions as is_within_distance
+
+        :param target_locations: (N, 2) array of the x, y target locations
+        :param reference_location: x, y location of the reference object
+        :param forward: x, y forward vector of the reference object
+        :return: a tuple of (N,) arrays with the distances and the angles in degrees,
+            being 0 a location in front and 180, one behind. The angle is nan for the
+            targets at the reference location
+    """
+    target_vectors = np.asarray(target_locations, dtype=np.float64).reshape(-1, 2)
+    target_vectors = target_vectors - np.asarray(reference_location)[:2]
+    norm_target = np.linalg.norm(target_vectors, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_angle = target_vectors @ np.asarray(forward)[:2] / norm_target
+    angle = np.degrees(np.arccos(np.clip(cos_angle, -1.0, 1.0)))
+
+    return norm_target, angle
+
+
+def is_within_distance_batch(
+    target_locations, reference_location, forward, max_distance, angle_interval=None
+):
+    """
+    Vectorized version of is_within_distance
+
+        :param target_locations: (N, 2) array of the x, y target locations
+        :param reference_location: x, y location of the reference object
+        :param forward: x, y forward vector of the reference object
+        :param max_distance: maximum allowed distance
+        :param angle_interval: only locations between [min, max] angles will be considered
+        :return: (N,) boolean array
+    """
+    norm_target, angle = compute_distances_and_angles(
+        target_locations, reference_location, forward
+    )
+    within = norm_target <= max_distance
+    if angle_interval:
+        with np.errstate(invalid='ignore'):
+            within &= (angle_interval[0] < angle) & (angle < angle_interval[1])
+
+    # If the vector is too short, the angle is not checked
+    return within | (norm_target < 0.001)
+
+
 def compute_magnitude_angle(target_location, current_location, orientation):
     """
     Compute relative angle and distance between a target_location and a current_location
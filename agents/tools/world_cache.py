@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+""" Module with a per tick cache of the world actors, shared by the agents and the
+sensors of a process. """
+
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from agents.tools.misc import get_trafficlight_trigger_location
+
+# Caches of the worlds used in this process, {world_id: WorldCache}
+_WORLD_CACHES = {}
+
+# Waypoint caches of the maps used in this process,
+# {(map_name, resolution, max_size): WaypointCache}
+_WAYPOINT_CACHES = {}
+
+
+def get_world_cache(world):
+    """
+    Returns the cache shared by everyone using the world in this process
+
+        :param world: carla.World object
+    """
+    if world.id not in _WORLD_CACHES:
+        _WORLD_CACHES[world.id] = WorldCache(world)
+    return _WORLD_CACHES[world.id]
+
+
+def get_waypoint_cache(carla_map, resolution=0.1, max_size=100000):
+    """
+    Returns the waypoint cache shared by everyone using the map in this process with
+    the same resolution and size
+
+        :param carla_map: carla.Map object
+        :param resolution: size in meters of the grid cells
+        :param max_size: maximum number of cached waypoints
+    """
+    key = (carla_map.name, resolution, max_size)
+    if key not in _WAYPOINT_CACHES:
+        _WAYPOINT_CACHES[key] = WaypointCache(carla_map, resolution, max_size)
+    return _WAYPOINT_CACHES[key]
+
+
+class WaypointCache(object):
+    """
+    Memoizes carla.Map.get_waypoint on a grid. The map is static, so all the
+    locations of a grid cell reuse the waypoint of the first query made in it.
+    The least recently used cells are evicted once there are max_size of them
+    """
+
+    def __init__(self, carla_map, resolution=0.1, max_size=100000):
+        self._map = carla_map
+        self.resolution = resolution
+        self.max_size = max_size
+        self._waypoints = OrderedDict()  # {(cell, *query args): waypoint}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_waypoint(self, location, *args, **kwargs):
+        """
+        Same as carla.Map.get_waypoint, for the grid cell of the location
+
+            :param location: carla.Location to project on the map
+        """
+        cell = (
+            int(np.floor(location.x / self.resolution)),
+            int(np.floor(location.y / self.resolution)),
+            int(np.floor(location.z / self.resolution)),
+        )
+        key = (cell, args, tuple(sorted(kwargs.items())))
+
+        if key in self._waypoints:
+            self.hits += 1
+            self._waypoints.move_to_end(key)
+            return self._waypoints[key]
+
+        self.misses += 1
+        waypoint = self._map.get_waypoint(location, *args, **kwargs)
+        self._waypoints[key] = waypoint
+        if len(self._waypoints) > self.max_size:
+            self._waypoints.popitem(last=False)
+        return waypoint
+
+    def get_stats(self):
+        """Returns the hit and miss counts of the cache"""
+        queries = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / queries if queries else 0.0,
+            'size': len(self._waypoints),
+        }
+
+
+class ActorGroup(object):
+    """
+    Actors of one kind, with their state at the cached frame as numpy arrays.
+    Row i of every array belongs to actors[i]. The state of static actors is only
+    read once
+    """
+
+    def __init__(self, actors=(), static=False):
+        self.actors = list(actors)
+        self.static = static
+        self._read = False
+        self.ids = np.array([actor.id for actor in self.actors], dtype=np.int64)
+
+        # Bounding boxes do not change, only read them once
+        extents = []
+        for actor in self.actors:
+            bounding_box = getattr(actor, 'bounding_box', None)
+            if bounding_box is None:
+                extents.append([0.0, 0.0, 0.0])
+            else:
+                extent = bounding_box.extent
+                extents.append([extent.x, extent.y, extent.z])
+        self.extents = np.array(extents, dtype=np.float64).reshape(-1, 3)
+
+        self.locations = np.zeros((len(self.actors), 3))
+        self.yaw = np.zeros(len(self.actors))
+        self.velocities = np.zeros((len(self.actors), 3))
+
+    def __len__(self):
+        return len(self.actors)
+
+    def __iter__(self):
+        return iter(self.actors)
+
+    def update(self, snapshot):
+        """Reads the state of the actors from the world snapshot"""
+        if self.static and self._read:
+            return
+        self._read = True
+
+        for i, actor_id in enumerate(self.ids):
+            actor_snapshot = snapshot.find(int(actor_id))
+            transform = actor_snapshot.get_transform()
+            velocity = actor_snapshot.get_velocity()
+
+            location = transform.location
+            self.locations[i] = (location.x, location.y, location.z)
+            self.yaw[i] = transform.rotation.yaw
+            self.velocities[i] = (velocity.x, velocity.y, velocity.z)
+
+
+class TrafficLightIndex(object):
+    """
+    Trigger waypoints of the traffic lights of a map. Trigger volumes never move, so
+    they are only projected on the map once
+    """
+
+    def __init__(self, traffic_lights, carla_map):
+        self.ids = frozenset(traffic_light.id for traffic_light in traffic_lights)
+        self._triggers = {}  # {traffic_light_id: (waypoint, road_id, forward vector)}
+        self._roads = defaultdict(list)  # {road_id: [traffic_light]}
+
+        for traffic_light in traffic_lights:
+            trigger_location = get_trafficlight_trigger_location(traffic_light)
+            waypoint = carla_map.get_waypoint(trigger_location)
+            forward = waypoint.transform.get_forward_vector()
+
+            self._triggers[traffic_light.id] = (
+                waypoint,
+                waypoint.road_id,
+                (forward.x, forward.y, forward.z),
+            )
+            self._roads[waypoint.road_id].append(traffic_light)
+
+    def get_trigger(self, traffic_light):
+        """Returns the (waypoint, road_id, forward vector) of the light's trigger"""
+        return self._triggers[traffic_light.id]
+
+    def on_road(self, road_id):
+        """Returns the traffic lights whose trigger is on the road"""
+        return self._roads.get(road_id, [])
+
+
+class WorldCache(object):
+    """
+    Cache of the world actors that is refreshed once per simulation frame. The
+    actors are only fetched and split by type again when the set of actor ids of the
+    snapshot changes, their state is always read from the snapshot
+    """
+
+    def __init__(self, world):
+        self._world = world
+        self._actor_ids = frozenset()
+        self._rows = {}  # {actor_id: (group, row)}
+        self._traffic_light_index = None
+        self.frame = None
+        self.snapshot = None
+
+        self.vehicles = ActorGroup()
+        self.walkers = ActorGroup()
+        self.traffic_lights = ActorGroup()
+        self.speed_limits = ActorGroup()
+
+    def _same_actors(self, group, actors):
+        return set(group.ids.tolist()) == {actor.id for actor in actors}
+
+    def _split_actors(self, actors):
+        """Splits the actors by type id"""
+        vehicles = []
+        traffic_lights = []
+        speed_limits = []
+        walkers = []
+
+        for actor in actors:
+            if 'vehicle' in actor.type_id:
+                vehicles.append(actor)
+            elif 'walker.pedestrian' in actor.type_id:
+                walkers.append(actor)
+            elif 'traffic_light' in actor.type_id:
+                traffic_lights.append(actor)
+            elif 'speed_limit' in actor.type_id:
+                speed_limits.append(actor)
+
+        self.vehicles = ActorGroup(vehicles)
+        self.walkers = ActorGroup(walkers)
+
+        # Traffic lights and speed limits never move, keep them while they are the
+        # same actors
+        if not self._same_actors(self.traffic_lights, traffic_lights):
+            self.traffic_lights = ActorGroup(traffic_lights, static=True)
+        if not self._same_actors(self.speed_limits, speed_limits):
+            self.speed_limits = ActorGroup(speed_limits, static=True)
+
+        self._rows = {}
+        for group in [
+            self.vehicles,
+            self.walkers,
+            self.traffic_lights,
+            self.speed_limits,
+        ]:
+            for row, actor in enumerate(group):
+                self._rows[actor.id] = (group, row)
+
+    def update(self):
+        """Refreshes the cache if the world has advanced to a new frame"""
+        snapshot = self._world.get_snapshot()
+        if snapshot.frame == self.frame:
+            return self
+
+        self.frame = snapshot.frame
+        self.snapshot = snapshot
+
+        actor_ids = frozenset(actor_snapshot.id for actor_snapshot in snapshot)
+        if actor_ids != self._actor_ids:
+            self._actor_ids = actor_ids
+            self._split_actors(self._world.get_actors(list(actor_ids)))
+
+        for group in [
+            self.vehicles,
+            self.walkers,
+            self.traffic_lights,
+            self.speed_limits,
+        ]:
+            group.update(snapshot)
+        return self
+
+    def get_state(self, actors):
+        """
+        Returns the (N, 3) locations, (N,) yaw and (N, 3) extents of the actors at
+        the cached frame
+
+            :param actors: list of cached carla.Actor objects
+        """
+        self.update()
+        rows = [self._rows[actor.id] for actor in actors]
+        locations = np.array([group.locations[row] for group, row in rows])
+        yaw = np.array([group.yaw[row] for group, row in rows])
+        extents = np.array([group.extents[row] for group, row in rows])
+        return locations.reshape(-1, 3), yaw, extents.reshape(-1, 3)
+
+    def get_traffic_light_index(self, carla_map):
+        """
+        Returns the trigger index of the traffic lights, only built again if the
+        traffic lights of the world change
+
+            :param carla_map: carla.Map object of the world
+        """
+        traffic_lights = self.update().traffic_lights
+        index = self._traffic_light_index
+        if index is None or index.ids != frozenset(traffic_lights.ids.tolist()):
+            self._traffic_light_index = TrafficLightIndex(traffic_lights, carla_map)
+        return self._traffic_light_index
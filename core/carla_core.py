@@ -369,15 +369,16 @@ class CarlaCore:
         if control is not None:
             self.apply_hero_control(control)
 
-        # Tick once the simulation
-        self.world.tick()
+        # Tick once the simulation and render the client side sensors
+        frame = self.world.tick()
+        self.sensor_interface.tick(frame)
 
         # Move the spectator
         if self.config["enable_rendering"]:
             self.set_spectator_camera_view()
 
         # Return the new sensor data
-        return self.get_sensor_data()
+        return self.get_sensor_data(frame)
 
     def set_spectator_camera_view(self):
         """This positions the spectator as a 3rd person view of the hero vehicle"""
@@ -408,9 +409,9 @@ class CarlaCore:
         """Applies the control calcualted at the experiment to the hero"""
         self.hero.apply_control(control)
 
-    def get_sensor_data(self):
+    def get_sensor_data(self, frame=None):
         """Returns the data sent by the different sensors at this tick"""
-        sensor_data = self.sensor_interface.get_data()
+        sensor_data = self.sensor_interface.get_data(frame)
         # print("---------")
         # world_frame = self.world.get_snapshot().frame
         # print("World frame: {}".format(world_frame))
@@ -8,17 +8,28 @@
 
 import glob
 import os
+import re
 import hashlib
 import math
 import pygame
-import time
-from threading import Thread
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
 
 try:
     import carla
+
+    # The agents' tools import carla too
+    from agents.tools.world_cache import get_world_cache
 except ModuleNotFoundError:
     pass
 
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
 from .sensor import PseudoSensor
 
 # ==============================================================================
@@ -71,16 +82,107 @@ COLOR_BLACK = pygame.Color(0, 0, 0)
 
 COLOR_PURPLE = pygame.Color(186, 85, 211)
 
+# Colors of the static map elements. A lane marking color of None uses the color of
+# the marking itself
+MAP_PALETTE = {
+    'background': COLOR_ALUMINIUM_4,
+    'shoulder': COLOR_ALUMINIUM_4_5,
+    'parking': COLOR_ALUMINIUM_4_5,
+    'sidewalk': COLOR_ALUMINIUM_3,
+    'road': COLOR_ALUMINIUM_5,
+    'lane_marking': None,
+    'arrow': COLOR_ALUMINIUM_2,
+    'traffic_sign': COLOR_ALUMINIUM_2,
+}
+
+# Channels of the semantic birdview masks. The static ones are rendered from the
+# map by drawing only their own elements
+MASK_CHANNELS = [
+    'drivable',
+    'lane',
+    'sidewalk',
+    'tl_red',
+    'tl_yellow',
+    'tl_green',
+    'vehicles',
+    'walkers',
+    'hero',
+]
+STATIC_MASK_ELEMENTS = {
+    'drivable': ['road'],
+    'lane': ['lane_marking'],
+    'sidewalk': ['sidewalk'],
+}
+
+
+def mask_palette(elements):
+    """Palette drawing the given map elements in white on a black background"""
+    palette = {key: COLOR_BLACK for key in MAP_PALETTE}
+    palette.update({key: COLOR_WHITE for key in elements})
+    return palette
+
+
+def unpack_birdview_masks(packed):
+    """Unpacks the bit packed birdview masks into a (size, size, channels) bool array"""
+    masks = np.unpackbits(packed, axis=-1, count=len(MASK_CHANNELS))
+    return masks.astype(bool)
+
+
 # ==============================================================================
 # -- MapImage ------------------------------------------------------------------
 # ==============================================================================
 
+# OpenDRIVE hashes of the maps already seen by this process, {map_name: hash}
+OPENDRIVE_HASHES = {}
+
+
+def pygame_to_array(surface):
+    """Copies a pygame surface into a contiguous (height, width, 3) uint8 array"""
+    return np.ascontiguousarray(pygame.surfarray.array3d(surface).swapaxes(0, 1))
+
+
+def get_opendrive_hash(carla_map, map_name):
+    """Hash of the OpenDRIVE content of the map, only computed once per map name"""
+    if map_name not in OPENDRIVE_HASHES:
+        hash_func = hashlib.sha1()
+        hash_func.update(carla_map.to_opendrive().encode("UTF-8"))
+        OPENDRIVE_HASHES[map_name] = str(hash_func.hexdigest())
+    return OPENDRIVE_HASHES[map_name]
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock shared by all the processes using the same path"""
+    with open(path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_or_render(path, render):
+    """Memory maps the cached .npy array, rendering it first if it does not exist.
+    Only one process renders it, the others wait for it and map the same file"""
+    if not os.path.isfile(path):
+        with file_lock(path + ".lock"):
+            if not os.path.isfile(path):
+                temp_path = path[: -len(".npy")] + ".tmp.npy"
+                np.save(temp_path, render())
+                os.replace(temp_path, path)
+    return np.load(path, mmap_mode="r")
+
 
 class MapImage(object):
     """
     Class encharged of rendering a 2D image from top view of a carla world (with pygame surfaces).
     A cache system is used, so if the OpenDrive content of a Carla town has not changed,
-    it will read and use the stored image if it was rendered in a previous execution
+    it will read and use the stored image if it was rendered in a previous execution.
+    The image is stored as a .npy array which all the processes memory map read only.
+    The numpy birdview backend reads it in place, the pygame backend still copies it
+    into a surface of its own in every process
     """
 
     def __init__(self, carla_world, carla_map, pixels_per_meter):
@@ -119,60 +221,75 @@ class MapImage(object):
         self._pixels_per_meter = surface_pixel_per_meter
         width_in_pixels = int(self._pixels_per_meter * self.width)
 
-        # Load OpenDrive content
-        opendrive_content = carla_map.to_opendrive()
-
-        # Get hash based on content
-        hash_func = hashlib.sha1()
-        hash_func.update(opendrive_content.encode("UTF-8"))
-        opendrive_hash = str(hash_func.hexdigest())
-
         # Build path for saving or loading the cached rendered map
         try:
             map_name = carla_map.name.split("/")[-1]
         except Exception:
             map_name = carla_map.name
-        filename = map_name + "_" + opendrive_hash + ".tga"
+        opendrive_hash = get_opendrive_hash(carla_map, map_name)
         self.dirname = "map_cache"
-        self.full_path = str(os.path.join(self.dirname, filename))
-
-        if os.path.isfile(self.full_path):
-            # Load image and scale it to the desired size
-            self.big_map_surface = pygame.image.load(self.full_path)
-            self.big_map_surface = pygame.transform.scale(
-                self.big_map_surface, (width_in_pixels, width_in_pixels)
-            )
-
-        else:
-            # Render map
-            self.big_map_surface = pygame.Surface((width_in_pixels, width_in_pixels))
-            self.draw_road_map(
-                self.big_map_surface, carla_world, carla_map, precision=0.05
-            )
-
-            # To avoid race conditions between multiple ray workers.
-            try:
-                os.makedirs(self.dirname)
-            except FileExistsError:
-                pass
+        os.makedirs(self.dirname, exist_ok=True)
+        self.cache_name = "_".join([map_name, opendrive_hash, str(width_in_pixels)])
+        self.full_path = str(os.path.join(self.dirname, self.cache_name + ".npy"))
 
+        def render():
             # Remove files if selected town had a previous version saved
-            list_filenames = glob.glob(os.path.join(self.dirname, carla_map.name) + "*")
-            for town_filename in list_filenames:
-                os.remove(town_filename)
-
-            # Save rendered map for next executions of same map
-            pygame.image.save(self.big_map_surface, self.full_path)
-
-        # self.draw_road_map(self.big_map_surface, carla_world, carla_map, precision=0.05)
-        self.surface = self.big_map_surface
-
-    def draw_road_map(self, map_surface, carla_world, carla_map, precision=0.05):
-        """Draws all the roads, including lane markings, arrows and traffic signs"""
-        map_surface.fill(COLOR_ALUMINIUM_4)
+            self.remove_outdated_cache(map_name, opendrive_hash)
+
+            surface = pygame.Surface((width_in_pixels, width_in_pixels))
+            self.draw_road_map(surface, carla_world, carla_map, precision=0.05)
+            return pygame_to_array(surface)
+
+        # Read only (height, width, 3) array shared by all the processes
+        self.array = load_or_render(self.full_path, render)
+        self._surface = None
+
+    @property
+    def surface(self):
+        """Pygame surface of the map, a private copy of the array only created if the
+        pygame renderer needs it"""
+        if self._surface is None:
+            self._surface = pygame.surfarray.make_surface(self.array.swapaxes(0, 1))
+        return self._surface
+
+    def remove_outdated_cache(self, map_name, opendrive_hash):
+        """Removes the cached renders of the map with a different OpenDRIVE content,
+        and the <map>_<hash>.tga renders of the previous cache format"""
+        pattern = re.compile(re.escape(map_name) + r"_([0-9a-f]{40})[_.]")
+        for filename in glob.glob(os.path.join(self.dirname, map_name + "_*")):
+            match = pattern.match(os.path.basename(filename))
+            if match and (
+                match.group(1) != opendrive_hash or filename.endswith(".tga")
+            ):
+                os.remove(filename)
+
+    def get_masks(self, carla_world, carla_map):
+        """Cached bitfield of the static mask channels, see render_masks"""
+        path = os.path.join(self.dirname, self.cache_name + "_masks.npy")
+        return load_or_render(path, lambda: self.render_masks(carla_world, carla_map))
+
+    def draw_road_map(
+        self,
+        map_surface,
+        carla_world,
+        carla_map,
+        precision=0.05,
+        palette=None,
+        elements=None,
+    ):
+        """Draws all the roads, including lane markings, arrows and traffic signs.
+        If elements is given, only those MAP_PALETTE elements are drawn"""
+        if palette is None:
+            palette = MAP_PALETTE
+        if elements is None:
+            elements = list(MAP_PALETTE)
+        map_surface.fill(palette['background'])
 
         def lane_marking_color_to_tango(lane_marking_color):
             """Maps the lane marking color enum specified in PythonAPI to a Tango Color"""
+            if palette['lane_marking'] is not None:
+                return palette['lane_marking']
+
             tango_color = COLOR_BLACK
 
             if lane_marking_color == carla.LaneMarkingColor.White:
@@ -339,7 +456,7 @@ class MapImage(object):
                 elif markings[0] == carla.LaneMarkingType.Broken:
                     draw_broken_line(surface, markings[1], False, markings[2], 2)
 
-        def draw_arrow(surface, transform, color=COLOR_ALUMINIUM_2):
+        def draw_arrow(surface, transform, color=palette['arrow']):
             """Draws an arrow with a specified color given a transform"""
             transform.rotation.yaw += 180
             forward = transform.get_forward_vector()
@@ -366,7 +483,7 @@ class MapImage(object):
             surface,
             font_surface,
             actor,
-            color=COLOR_ALUMINIUM_2,
+            color=palette['traffic_sign'],
             trigger_color=COLOR_PLUM_0,
         ):
             """Draw stop traffic signs and its bounding box if enabled"""
@@ -423,9 +540,9 @@ class MapImage(object):
                 set_waypoints.append(waypoints)
 
                 # Draw Shoulders, Parkings and Sidewalks
-                PARKING_COLOR = COLOR_ALUMINIUM_4_5
-                SHOULDER_COLOR = COLOR_ALUMINIUM_4_5
-                SIDEWALK_COLOR = COLOR_ALUMINIUM_3
+                PARKING_COLOR = palette['parking']
+                SHOULDER_COLOR = palette['shoulder']
+                SIDEWALK_COLOR = palette['sidewalk']
 
                 shoulder = [[], []]
                 parking = [[], []]
@@ -471,9 +588,12 @@ class MapImage(object):
                         r = r.get_right_lane()
 
                 # Draw classified lane types
-                draw_lane(map_surface, shoulder, SHOULDER_COLOR)
-                draw_lane(map_surface, parking, PARKING_COLOR)
-                draw_lane(map_surface, sidewalk, SIDEWALK_COLOR)
+                if 'shoulder' in elements:
+                    draw_lane(map_surface, shoulder, SHOULDER_COLOR)
+                if 'parking' in elements:
+                    draw_lane(map_surface, parking, PARKING_COLOR)
+                if 'sidewalk' in elements:
+                    draw_lane(map_surface, sidewalk, SIDEWALK_COLOR)
 
             # Draw Roads
             for waypoints in set_waypoints:
@@ -488,20 +608,25 @@ class MapImage(object):
                 polygon = road_left_side + [x for x in reversed(road_right_side)]
                 polygon = [self.world_to_pixel(x) for x in polygon]
 
-                if len(polygon) > 2:
-                    pygame.draw.polygon(map_surface, COLOR_ALUMINIUM_5, polygon, 5)
-                    pygame.draw.polygon(map_surface, COLOR_ALUMINIUM_5, polygon)
+                if len(polygon) > 2 and 'road' in elements:
+                    pygame.draw.polygon(map_surface, palette['road'], polygon, 5)
+                    pygame.draw.polygon(map_surface, palette['road'], polygon)
 
                 # Draw Lane Markings and Arrows
                 if not waypoint.is_junction:
-                    draw_lane_marking(map_surface, [waypoints, waypoints])
-                    for n, wp in enumerate(waypoints):
-                        if ((n + 1) % 400) == 0:
-                            draw_arrow(map_surface, wp.transform)
+                    if 'lane_marking' in elements:
+                        draw_lane_marking(map_surface, [waypoints, waypoints])
+                    if 'arrow' in elements:
+                        for n, wp in enumerate(waypoints):
+                            if ((n + 1) % 400) == 0:
+                                draw_arrow(map_surface, wp.transform)
 
         topology = carla_map.get_topology()
         draw_topology(topology, 0)
 
+        if 'traffic_sign' not in elements:
+            return
+
         actors = carla_world.get_actors()
 
         # Find and Draw Traffic Signs: Stops and Yields
@@ -511,13 +636,13 @@ class MapImage(object):
         stops = [actor for actor in actors if 'stop' in actor.type_id]
         yields = [actor for actor in actors if 'yield' in actor.type_id]
 
-        stop_font_surface = font.render("STOP", False, COLOR_ALUMINIUM_2)
+        stop_font_surface = font.render("STOP", False, palette['traffic_sign'])
         stop_font_surface = pygame.transform.scale(
             stop_font_surface,
             (stop_font_surface.get_width(), stop_font_surface.get_height() * 2),
         )
 
-        yield_font_surface = font.render("YIELD", False, COLOR_ALUMINIUM_2)
+        yield_font_surface = font.render("YIELD", False, palette['traffic_sign'])
         yield_font_surface = pygame.transform.scale(
             yield_font_surface,
             (yield_font_surface.get_width(), yield_font_surface.get_height() * 2),
@@ -536,6 +661,25 @@ class MapImage(object):
                 map_surface, yield_font_surface, ts_yield, trigger_color=COLOR_ORANGE_1
             )
 
+    def render_masks(self, carla_world, carla_map, precision=0.05):
+        """Renders the static mask channels of the map as a bitfield array, where
+        bit i is set if the pixel belongs to the channel MASK_CHANNELS[i]"""
+        size = (self.array.shape[1], self.array.shape[0])
+        surface = pygame.Surface(size)
+        masks = np.zeros(size[::-1], dtype=np.uint8)
+        for channel, elements in STATIC_MASK_ELEMENTS.items():
+            self.draw_road_map(
+                surface,
+                carla_world,
+                carla_map,
+                precision,
+                palette=mask_palette(elements),
+                elements=elements,
+            )
+            layer = pygame.surfarray.pixels_red(surface).T > 0
+            masks[layer] |= 1 << MASK_CHANNELS.index(channel)
+        return masks
+
     def world_to_pixel(self, location, offset=(0, 0), other_scale=1):
         """Converts the world coordinates to pixel coordinates"""
         x = self._pixels_per_meter * (location.x - self._world_offset[0]) * other_scale
@@ -588,23 +732,14 @@ class BirdviewSensor(object):
         self.final_surface = pygame.Surface((size, size))  # rotation
 
     def _split_actors(self):
-        """Splits the retrieved actors by type id"""
-        vehicles = []
-        traffic_lights = []
-        speed_limits = []
-        walkers = []
-
-        for actor in self.world.get_actors():
-            if 'vehicle' in actor.type_id:
-                vehicles.append(actor)
-            elif 'walker.pedestrian' in actor.type_id:
-                walkers.append((actor))
-            elif 'traffic_light' in actor.type_id:
-                traffic_lights.append(actor)
-            elif 'speed_limit' in actor.type_id:
-                speed_limits.append(actor)
-
-        return (vehicles, traffic_lights, speed_limits, walkers)
+        """Returns the actors split by type id, from the per tick world cache"""
+        world_cache = get_world_cache(self.world).update()
+        return (
+            world_cache.vehicles,
+            world_cache.traffic_lights,
+            world_cache.speed_limits,
+            world_cache.walkers,
+        )
 
     def _render_traffic_lights(self, surface, traffic_lights):
         """Renders the traffic lights and shows its triggers and bounding boxes if flags are enabled"""
@@ -766,15 +901,258 @@ class BirdviewSensor(object):
         pygame.quit()
 
 
-def threaded(fn):
-    def wrapper(*args, **kwargs):
-        thread = Thread(target=fn, args=args, kwargs=kwargs)
-        thread.setDaemon(True)
-        thread.start()
+# ==============================================================================
+# -- NumpyBirdviewSensor -------------------------------------------------------
+# ==============================================================================
+
+
+def to_rgb(color):
+    return (color.r, color.g, color.b)
+
+
+# Bounding box outlines in the actor frame, in units of the box extent
+VEHICLE_OUTLINE = np.array(
+    [[-1, -1], [1, -1], [1, 0], [1, 1], [-1, 1], [-1, -1]], dtype=np.float64
+)
+WALKER_OUTLINE = np.array([[-2, -2], [2, -2], [2, 2], [-2, 2]], dtype=np.float64)
+
+
+class NumpyBirdviewSensor(BirdviewSensor):
+    """Renders the same egocentric birdview as BirdviewSensor straight into numpy
+    arrays. Only the visible crop of the static map raster is warped, and the
+    actors are transformed all at once and drawn in the output image.
+
+    In 'mask' mode, the output is a (size, size, len(MASK_CHANNELS)) bool array of
+    semantic masks instead, bit packed along the channels if 'packed'"""
+
+    def __init__(self, world, size, radius, hero, mode='rgb', packed=True):
+        pygame.init()
+        if mode not in ['rgb', 'mask']:
+            raise ValueError("Unknown birdview mode {}".format(mode))
+        self.mode = mode
+        self.packed = packed
+
+        self.world = world
+        self.town_map = self.world.get_map()
+        self.radius = radius
+        self.size = size
+
+        self.hero = hero
+        self.hero_transform = self.hero.get_transform()
+        self.pixels_per_meter = size / (2 * self.radius)
+        self.map_image = MapImage(self.world, self.town_map, self.pixels_per_meter)
+
+        # Static elements
+        if self.mode == 'rgb':
+            self.map_raster = self.map_image.array
+        else:
+            self.mask_raster = self.map_image.get_masks(self.world, self.town_map)
+
+    def _egocentric_transform(self):
+        """Affine transform from map pixels to output pixels. Equivalent to the
+        translation and rotozoom of BirdviewSensor"""
+        # Angle on with to rotate to make the view egocentric
+        angle = self.hero_transform.rotation.yaw + 90.0
+
+        # The center of the output is a point in front of the ego vehicle
+        hero_center_location = (
+            self.hero_transform.location
+            + self.hero_transform.get_forward_vector() * self.radius / 2
+        )
+        hero_screen_location = self.map_image.world_to_pixel(hero_center_location)
+        offset = np.array(hero_screen_location, dtype=np.float64) - self.size / 2
+
+        # Zoom by sqrt(2) to avoid seeing black corners
+        center = (self.size / 2, self.size / 2)
+        matrix = cv2.getRotationMatrix2D(center, angle, math.sqrt(2))
+        matrix[:, 2] -= matrix[:, :2] @ offset
+        return matrix, np.floor(offset).astype(int), angle
+
+    def _render_map(self, raster, matrix, offset, fill=0):
+        """Warps only the visible crop of a map raster into the output image"""
+        height, width = raster.shape[:2]
+        x0, y0 = max(offset[0], 0), max(offset[1], 0)
+        x1 = min(offset[0] + self.size + 1, width)
+        y1 = min(offset[1] + self.size + 1, height)
+
+        shape = (self.size, self.size) + raster.shape[2:]
+        if x0 >= x1 or y0 >= y1:
+            return np.full(shape, fill, dtype=raster.dtype)
+
+        # Move the origin to the one of the crop
+        crop_matrix = matrix.copy()
+        crop_matrix[:, 2] += matrix[:, :2] @ np.array([x0, y0], dtype=np.float64)
+        return cv2.warpAffine(
+            raster[y0:y1, x0:x1],
+            crop_matrix,
+            (self.size, self.size),
+            flags=cv2.INTER_NEAREST,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=fill,
+        )
+
+    def _to_output(self, points, matrix):
+        """Converts world locations (..., 2) to output pixel coordinates"""
+        pixels = self.map_image._pixels_per_meter * (
+            points - np.array(self.map_image._world_offset)
+        )
+        return pixels @ matrix[:, :2].T + matrix[:, 2]
+
+    def _actor_polygons(self, actors, outline, matrix, front_offset=0.0):
+        """Transforms the bounding box outlines of a cached actor group at once and
+        returns the ones that are visible as (N, K, 2) output pixels"""
+        if not len(actors):
+            return np.zeros((0, len(outline), 2), dtype=np.int32), []
+
+        location = actors.locations[:, :2]
+        yaw = np.radians(actors.yaw)
+        extent = actors.extents[:, :2]
+
+        # Local corners, the vehicles' side corners are pulled back to draw an arrow
+        corners = outline[np.newaxis] * extent[:, np.newaxis]
+        if front_offset:
+            corners[:, [1, 3], 0] -= front_offset
+
+        cos, sin = np.cos(yaw)[:, np.newaxis], np.sin(yaw)[:, np.newaxis]
+        world = np.stack(
+            [
+                location[:, 0:1] + cos * corners[..., 0] - sin * corners[..., 1],
+                location[:, 1:2] + sin * corners[..., 0] + cos * corners[..., 1],
+            ],
+            axis=-1,
+        )
+        polygons = np.round(self._to_output(world, matrix)).astype(np.int32)
+
+        # Cull the actors outside of the view
+        inside = (polygons >= 0) & (polygons < self.size)
+        visible = inside.all(axis=-1).any(axis=-1)
+        return polygons[visible], visible
+
+    def _traffic_light_color(self, state):
+        if state == carla.TrafficLightState.Red:
+            return to_rgb(COLOR_SCARLET_RED_0)
+        elif state == carla.TrafficLightState.Yellow:
+            return to_rgb(COLOR_BUTTER_0)
+        elif state == carla.TrafficLightState.Green:
+            return to_rgb(COLOR_CHAMELEON_0)
+        elif state == carla.TrafficLightState.Off:
+            return to_rgb(COLOR_ALUMINIUM_4)
+        return to_rgb(COLOR_BLACK)
+
+    def _actor_centers(self, actors, matrix, radius):
+        """Returns the output centers of the actors, and the radius in output pixels"""
+        radius = int(round(self.map_image.world_to_pixel_width(radius) * math.sqrt(2)))
+        if not len(actors):
+            return np.zeros((0, 2), dtype=np.int32), radius
+        centers = self._to_output(actors.locations[:, :2], matrix)
+        centers = np.round(centers).astype(np.int32)
+        return centers, radius
+
+    def render_actors(self, image, matrix):
+        """Renders all the actors on top of the map"""
+        vehicles, traffic_lights, speed_limits, walkers = self._split_actors()
+
+        # Static actors
+        centers, radius = self._actor_centers(traffic_lights, matrix, 1.4)
+        for tl, center in zip(traffic_lights, centers):
+            center = tuple(int(c) for c in center)
+            color = self._traffic_light_color(tl.state)
+            cv2.circle(image, center, radius, color, -1)
+            cv2.circle(image, center, radius, to_rgb(COLOR_WHITE), 1)
+
+        centers, radius = self._actor_centers(speed_limits, matrix, 2)
+        for sl, center in zip(speed_limits, centers):
+            center = tuple(int(c) for c in center)
+            cv2.circle(image, center, radius, to_rgb(COLOR_SCARLET_RED_1), -1)
+            cv2.circle(image, center, int(radius * 0.75), to_rgb(COLOR_ALUMINIUM_0), -1)
+
+            # Speed limit text, upright in the egocentric view
+            limit = sl.type_id.split('.')[2]
+            scale = radius / 30
+            (width, height), _ = cv2.getTextSize(
+                limit, cv2.FONT_HERSHEY_SIMPLEX, scale, 1
+            )
+            origin = (center[0] - width // 2, center[1] + height // 2)
+            cv2.putText(
+                image,
+                limit,
+                origin,
+                cv2.FONT_HERSHEY_SIMPLEX,
+                scale,
+                to_rgb(COLOR_ALUMINIUM_5),
+                1,
+            )
+
+        # Dynamic actors
+        polygons, visible = self._actor_polygons(
+            vehicles, VEHICLE_OUTLINE, matrix, front_offset=0.8
+        )
+        vehicles = [v for v, keep in zip(vehicles, visible) if keep]
+        for v, polygon in zip(vehicles, polygons):
+            color = COLOR_SKY_BLUE_0
+            if int(v.attributes['number_of_wheels']) == 2:
+                color = COLOR_CHOCOLATE_1
+            if v.attributes['role_name'] == 'hero':
+                color = COLOR_CHAMELEON_0
+            cv2.fillPoly(image, [polygon], to_rgb(color))
+
+        polygons, _ = self._actor_polygons(walkers, WALKER_OUTLINE, matrix)
+        if len(polygons):
+            cv2.fillPoly(image, list(polygons), to_rgb(COLOR_PLUM_0))
+
+    def render_masks(self, matrix, offset):
+        """Renders the static and actor masks"""
+        size = (self.size, self.size)
+        layers = {channel: np.zeros(size, dtype=np.uint8) for channel in MASK_CHANNELS}
+
+        # Static channels are stored as bits of the mask raster
+        bits = self._render_map(self.mask_raster, matrix, offset)
+        for channel in STATIC_MASK_ELEMENTS:
+            layers[channel] = (bits >> MASK_CHANNELS.index(channel)) & 1
+
+        vehicles, traffic_lights, _, walkers = self._split_actors()
+
+        # Traffic lights by state
+        tl_channels = {
+            carla.TrafficLightState.Red: 'tl_red',
+            carla.TrafficLightState.Yellow: 'tl_yellow',
+            carla.TrafficLightState.Green: 'tl_green',
+        }
+        centers, radius = self._actor_centers(traffic_lights, matrix, 1.4)
+        for tl, center in zip(traffic_lights, centers):
+            if tl.state in tl_channels:
+                center = tuple(int(c) for c in center)
+                cv2.circle(layers[tl_channels[tl.state]], center, radius, 1, -1)
+
+        # Dynamic actors
+        polygons, visible = self._actor_polygons(
+            vehicles, VEHICLE_OUTLINE, matrix, front_offset=0.8
+        )
+        vehicles = [v for v, keep in zip(vehicles, visible) if keep]
+        for v, polygon in zip(vehicles, polygons):
+            channel = 'hero' if v.attributes['role_name'] == 'hero' else 'vehicles'
+            cv2.fillPoly(layers[channel], [polygon], 1)
+
+        polygons, _ = self._actor_polygons(walkers, WALKER_OUTLINE, matrix)
+        if len(polygons):
+            cv2.fillPoly(layers['walkers'], list(polygons), 1)
 
-        return thread
+        masks = np.stack([layers[c] for c in MASK_CHANNELS], axis=-1).astype(bool)
+        if self.packed:
+            return np.packbits(masks, axis=-1)
+        return masks
 
-    return wrapper
+    def get_data(self):
+        """Renders the map and all the actors in hero mode"""
+        self.hero_transform = self.hero.get_transform()
+        matrix, offset, _ = self._egocentric_transform()
+
+        if self.mode == 'mask':
+            return self.render_masks(matrix, offset)
+
+        image = self._render_map(self.map_raster, matrix, offset)
+        self.render_actors(image, matrix)
+        return image
 
 
 class BirdviewManager(PseudoSensor):
@@ -787,34 +1165,40 @@ class BirdviewManager(PseudoSensor):
         super().__init__(name, attributes, interface, parent)
 
         self.world = parent.get_world()
-        self.running = False  # Flag to stop the execution of the sensor
         self.previous_frame = None
 
-        # Get the sensor instance and run it
-        self.sensor = BirdviewSensor(
-            self.world, attributes["size"], attributes["radius"], parent
-        )
-        self.run()
-
-    @threaded
-    def run(self):
-        """Function to copy the functionality of CARLA sensor.listen() callback,
-        responsible of sending the data of the sensor each tick"""
-        self.running = True
-        self.previous_frame = self.world.get_snapshot().frame
-        while self.running:
-            frame = self.world.get_snapshot().frame
-
-            # Avoid getting the data more than once per frame
-            if frame > self.previous_frame:
-                self.callback(self.sensor.get_data(), frame)
-                self.previous_frame = frame
-            else:
-                time.sleep(0.005)
+        # Get the sensor instance. The 'numpy' backend renders straight into arrays
+        # and reads the cached map shared by the processes in place, the 'pygame'
+        # backend needs map sized surfaces in every process
+        # The semantic 'mask' mode is only available with the numpy backend
+        backend = attributes.get("backend", "pygame")
+        mode = attributes.get("mode", "rgb")
+        if backend == "pygame" and mode == "rgb":
+            self.sensor = BirdviewSensor(
+                self.world, attributes["size"], attributes["radius"], parent
+            )
+        elif backend == "numpy":
+            self.sensor = NumpyBirdviewSensor(
+                self.world,
+                attributes["size"],
+                attributes["radius"],
+                parent,
+                mode=mode,
+                packed=attributes.get("packed", True),
+            )
+        else:
+            raise ValueError(
+                "Unsupported birdview backend {} with mode {}".format(backend, mode)
+            )
+
+    def tick(self, frame):
+        """Renders the birdview once per frame, called after each world tick"""
+        if frame != self.previous_frame:
+            self.callback(self.sensor.get_data(), frame)
+            self.previous_frame = frame
 
     def destroy(self):
         """Stop the sensor and its execution"""
-        self.running = False
         self.sensor.destroy()
 
     def parse(self, data):
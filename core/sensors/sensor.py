@@ -9,7 +9,6 @@
 Here are defined all the CARLA sensors
 """
 
-import copy
 import math
 import numpy as np
 
@@ -17,18 +16,57 @@ try:
     import carla
 except ModuleNotFoundError:
     pass
+
+
+class LazySensorData(object):
+    """Holds the raw sensor data and only parses it when it is first read"""
+
+    def __init__(self, parse, data) -> None:
+        self._parse = parse
+        self._data = data
+        self._parsed = None
+
+    def get(self):
+        if self._parse is not None:
+            self._parsed = self._parse(self._data)
+            # Release the raw data
+            self._parse, self._data = None, None
+        return self._parsed
+
+
+def materialize(data):
+    """Parses the lazy sensor data of a dictionary {sensor_name: sensor_data}"""
+    return {
+        key: value.get() if isinstance(value, LazySensorData) else value
+        for key, value in data.items()
+    }
+
+
 # ==================================================================================================
 # -- BaseSensor -----------------------------------------------------------------------------------
 # ==================================================================================================
 
 
 class BaseSensor(object):
+    # Options handled here instead of being passed to CARLA, as {option: default}
+    # lazy: keep the raw data and parse it only when it is read, see LazySensorData
+    OPTIONS = {'lazy': False}
+
     def __init__(self, name, attributes, interface, parent):
         self.name = name
         self.attributes = attributes
         self.interface = interface
         self.parent = parent
 
+        # Collect the options of the whole class hierarchy
+        self.options = {}
+        for cls in reversed(type(self).__mro__):
+            for option, default in cls.__dict__.get('OPTIONS', {}).items():
+                self.options[option] = self.attributes.pop(option, default)
+
+        # Sensors with a sensor_tick do not produce data at every frame
+        self.sensor_tick = float(attributes.get('sensor_tick', 0))
+
         self.interface.register(self.name, self)
 
     def is_event_sensor(self):
@@ -37,15 +75,39 @@ class BaseSensor(object):
     def parse(self):
         raise NotImplementedError
 
+    def reduce_events(self, events):
+        """Reduces all the events of a frame into the sensor data"""
+        return events[-1]
+
+    def reduce(self, events):
+        """Reduces the events of a frame with the 'reducer' option. It can be
+        'list', 'first', 'last' or 'default', which uses the sensor's reduce_events"""
+        reducer = self.options.get('reducer', 'default')
+        if reducer == 'list':
+            return events
+        elif reducer == 'first':
+            return events[0]
+        elif reducer == 'last':
+            return events[-1]
+        elif reducer == 'default':
+            return self.reduce_events(events)
+        raise ValueError("Unknown reducer {} for sensor {}".format(reducer, self.name))
+
     def update_sensor(self, data, frame):
-        if not self.is_event_sensor():
-            self.interface._data_buffers.put((self.name, frame, self.parse(data)))
+        # Event sensors are always parsed, their events are reduced every frame
+        if self.options['lazy'] and not self.is_event_sensor():
+            self.interface.put(self.name, frame, LazySensorData(self.parse, data))
         else:
-            self.interface._event_data_buffers.put((self.name, frame, self.parse(data)))
+            self.interface.put(self.name, frame, self.parse(data))
 
     def callback(self, data):
         self.update_sensor(data, data.frame)
 
+    def tick(self, frame):
+        """Called after each world tick. Sensors computed on the client, which have
+        no CARLA callback, produce their data of the frame here"""
+        pass
+
     def destroy(self):
         raise NotImplementedError
 
@@ -92,17 +154,49 @@ class PseudoSensor(BaseSensor):
 # ==================================================================================================
 # -- Cameras -----------------------------------------------------------------------------------
 # ==================================================================================================
+class BufferRing(object):
+    """Ring of preallocated arrays that are reused every 'size' frames"""
+
+    def __init__(self, size) -> None:
+        self.size = size
+        self._buffers = []
+        self._index = 0
+
+    def next(self, shape, dtype):
+        """Returns the next buffer of the ring, reallocating it if the shape changed"""
+        first = self._buffers[0] if self._buffers else None
+        if first is None or first.shape != shape or first.dtype != dtype:
+            self._buffers = [np.empty(shape, dtype=dtype) for _ in range(self.size)]
+
+        buffer = self._buffers[self._index]
+        self._index = (self._index + 1) % self.size
+        return buffer
+
+
 class BaseCamera(CarlaSensor):
+    # copy: False returns views into a ring of 'buffer_size' preallocated images,
+    # which are overwritten after 'buffer_size' frames. WebDatasetWriter checks
+    # that the ring outlives the samples waiting to be written
+    OPTIONS = {'copy': True, 'buffer_size': 4}
+
     def __init__(self, name, attributes, interface, parent):
         super().__init__(name, attributes, interface, parent)
+        self.ring = BufferRing(int(self.options['buffer_size']))
 
     def parse(self, sensor_data):
-        """Parses the Image into an numpy array"""
+        """Parses the Image into a contiguous RGB numpy array"""
         # sensor_data: [fov, height, width, raw_data]
-        array = np.frombuffer(sensor_data.raw_data, dtype=np.dtype("uint8"))
-        array = np.reshape(array, (sensor_data.height, sensor_data.width, 4))
-        array = array[:, :, :3]
-        array = array[:, :, ::-1]
+        bgra = np.frombuffer(sensor_data.raw_data, dtype=np.dtype("uint8"))
+        bgra = np.reshape(bgra, (sensor_data.height, sensor_data.width, 4))
+
+        shape = (sensor_data.height, sensor_data.width, 3)
+        if self.options['copy']:
+            array = np.empty(shape, dtype=np.uint8)
+        else:
+            array = self.ring.next(shape, np.uint8)
+
+        # Single BGRA to RGB copy into the output
+        np.copyto(array, bgra[:, :, 2::-1])
         return array
 
 
@@ -121,75 +215,176 @@ class CameraSemanticSegmentation(BaseCamera):
         super().__init__(name, attributes, interface, parent)
 
 
+DVS_EVENT_DTYPE = np.dtype(
+    [('x', np.uint16), ('y', np.uint16), ('t', np.int64), ('pol', np.bool_)]
+)
+DVS_SPARSE_DTYPE = np.dtype(
+    [('bin', np.uint16), ('y', np.uint16), ('x', np.uint16), ('value', np.float32)]
+)
+
+
 class CameraDVS(CarlaSensor):
+    # output: 'image' (RGB polarity image), 'voxel' (time_bins, H, W) grid of the
+    # signed polarities or 'sparse', the non zero cells of the grid as COO records
+    # copy: False writes the image and voxel outputs into a ring of 'buffer_size'
+    # preallocated arrays, see BaseCamera
+    OPTIONS = {
+        'reducer': 'default',
+        'output': 'image',
+        'time_bins': 5,
+        'copy': True,
+        'buffer_size': 4,
+    }
+
     def __init__(self, name, attributes, interface, parent):
         super().__init__(name, attributes, interface, parent)
+        if self.options['output'] not in ['image', 'voxel', 'sparse']:
+            raise ValueError("Unknown DVS output {}".format(self.options['output']))
+        self.ring = BufferRing(int(self.options['buffer_size']))
 
     def is_event_sensor(self):
         return True
 
+    def _get_buffer(self, shape, dtype):
+        if self.options['copy']:
+            return np.zeros(shape, dtype=dtype)
+        buffer = self.ring.next(shape, dtype)
+        buffer.fill(0)
+        return buffer
+
+    def _time_bins(self, t):
+        """Splits the events of the callback into time_bins equal time intervals"""
+        time_bins = int(self.options['time_bins'])
+        if len(t) == 0:
+            return np.zeros(0, dtype=np.int64)
+        duration = int(t.max() - t.min()) + 1
+        return (t - t.min()) * time_bins // duration
+
     def parse(self, sensor_data):
-        """Parses the DVSEvents into an RGB image"""
+        """Parses the DVSEvents into an RGB image or an event tensor"""
         # sensor_data: [x, y, t, polarity]
-        dvs_events = np.frombuffer(
-            sensor_data.raw_data,
-            dtype=np.dtype(
-                [('x', np.uint16), ('y', np.uint16), ('t', np.int64), ('pol', np.bool)]
-            ),
-        )
-
-        dvs_img = np.zeros((sensor_data.height, sensor_data.width, 3), dtype=np.uint8)
-        dvs_img[
-            dvs_events[:]['y'], dvs_events[:]['x'], dvs_events[:]['pol'] * 2
-        ] = 255  # Blue is positive, red is negative
-
-        return dvs_img
+        dvs_events = np.frombuffer(sensor_data.raw_data, dtype=DVS_EVENT_DTYPE)
+        height, width = sensor_data.height, sensor_data.width
+
+        if self.options['output'] == 'image':
+            dvs_img = self._get_buffer((height, width, 3), np.uint8)
+            dvs_img[
+                dvs_events['y'], dvs_events['x'], dvs_events['pol'] * 2
+            ] = 255  # Blue is positive, red is negative
+            return dvs_img
+
+        # Flat index of every event in the (time_bins, H, W) grid
+        time_bins = int(self.options['time_bins'])
+        index = self._time_bins(dvs_events['t']) * height * width
+        index += dvs_events['y'].astype(np.int64) * width + dvs_events['x']
+        polarity = np.where(dvs_events['pol'], 1.0, -1.0).astype(np.float32)
+
+        if self.options['output'] == 'voxel':
+            grid = self._get_buffer((time_bins, height, width), np.float32)
+            np.add.at(grid.reshape(-1), index, polarity)
+            return grid
+
+        # Accumulate the events falling in the same cell
+        cells, inverse = np.unique(index, return_inverse=True)
+        values = np.bincount(inverse, weights=polarity, minlength=len(cells))
+        non_zero = values != 0
+        cells = cells[non_zero]
+
+        sparse = np.empty(len(cells), dtype=DVS_SPARSE_DTYPE)
+        sparse['bin'], pixel = np.divmod(cells, height * width)
+        sparse['y'], sparse['x'] = np.divmod(pixel, width)
+        sparse['value'] = values[non_zero]
+        return sparse
 
 
 # ==================================================================================================
 # -- LIDAR -----------------------------------------------------------------------------------
 # ==================================================================================================
-class Lidar(CarlaSensor):
+LIDAR_DTYPE = np.dtype([('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('intensity', 'f4')])
+SEMANTIC_LIDAR_DTYPE = np.dtype(
+    [
+        ('x', 'f4'),
+        ('y', 'f4'),
+        ('z', 'f4'),
+        ('cos_angle', 'f4'),
+        ('obj_idx', 'u4'),
+        ('obj_tag', 'u4'),
+    ]
+)
+# Memory layout of carla.RadarDetection
+RADAR_DTYPE = np.dtype(
+    [('velocity', 'f4'), ('azimuth', 'f4'), ('altitude', 'f4'), ('depth', 'f4')]
+)
+
+
+def voxel_downsample(points, voxel_size):
+    """Keeps the first point of every voxel, preserving the point order"""
+    xyz = np.stack([points['x'], points['y'], points['z']], axis=-1)
+    voxels = np.floor(xyz / voxel_size).astype(np.int64)
+    _, first = np.unique(voxels, axis=0, return_index=True)
+    return points[np.sort(first)]
+
+
+class BaseLidar(CarlaSensor):
+    # max_range: drop the points further than it (m)
+    # voxel_size: keep a single point per voxel of this size (m)
+    OPTIONS = {'max_range': None, 'voxel_size': None}
+    DTYPE = LIDAR_DTYPE
+
     def __init__(self, name, attributes, interface, parent):
         super().__init__(name, attributes, interface, parent)
 
     def parse(self, sensor_data):
-        """Parses the LidarMeasurememt into an numpy array"""
-        # sensor_data: [x, y, z, intensity]
-        points = np.frombuffer(sensor_data.raw_data, dtype=np.dtype('f4'))
-        points = copy.deepcopy(points)
-        points = np.reshape(points, (int(points.shape[0] / 4), 4))
+        """Parses the measurement into a structured numpy array"""
+        points = np.frombuffer(sensor_data.raw_data, dtype=self.DTYPE)
+
+        # Filtering copies the points, otherwise copy them out of the CARLA buffer
+        max_range = self.options['max_range']
+        if max_range is not None:
+            squared_range = points['x'] ** 2 + points['y'] ** 2 + points['z'] ** 2
+            points = points[squared_range <= float(max_range) ** 2]
+        else:
+            points = points.copy()
+
+        if self.options['voxel_size'] is not None:
+            points = voxel_downsample(points, float(self.options['voxel_size']))
         return points
 
 
-class SemanticLidar(CarlaSensor):
+class Lidar(BaseLidar):
+    # sensor_data: [x, y, z, intensity]
+    DTYPE = LIDAR_DTYPE
+
     def __init__(self, name, attributes, interface, parent):
         super().__init__(name, attributes, interface, parent)
 
-    def parse(self, sensor_data):
-        """Parses the SemanticLidarMeasurememt into an numpy array"""
-        # sensor_data: [x, y, z, cos(angle), actor index, semantic tag]
-        points = np.frombuffer(sensor_data.raw_data, dtype=np.dtype('f4'))
-        points = copy.deepcopy(points)
-        points = np.reshape(points, (int(points.shape[0] / 6), 6))
-        return points
+
+class SemanticLidar(BaseLidar):
+    # sensor_data: [x, y, z, cos(angle), actor index, semantic tag]
+    DTYPE = SEMANTIC_LIDAR_DTYPE
+
+    def __init__(self, name, attributes, interface, parent):
+        super().__init__(name, attributes, interface, parent)
 
 
 # ==================================================================================================
 # -- Others -----------------------------------------------------------------------------------
 # ==================================================================================================
 class Radar(CarlaSensor):
+    # max_range: drop the detections further than it (m)
+    OPTIONS = {'max_range': None}
+
     def __init__(self, name, attributes, interface, parent):
         super().__init__(name, attributes, interface, parent)
 
     def parse(self, sensor_data):
-        """Parses the RadarMeasurement into an numpy array"""
-        # sensor_data: [depth, azimuth, altitute, velocity]
-        points = np.frombuffer(sensor_data.raw_data, dtype=np.dtype('f4'))
-        points = copy.deepcopy(points)
-        points = np.reshape(points, (int(points.shape[0] / 4), 4))
-        points = np.flip(points, 1)
-        return points
+        """Parses the RadarMeasurement into a structured numpy array"""
+        # sensor_data: [velocity, azimuth, altitude, depth]
+        points = np.frombuffer(sensor_data.raw_data, dtype=RADAR_DTYPE)
+        max_range = self.options['max_range']
+        if max_range is not None:
+            return points[points['depth'] <= float(max_range)]
+        return points.copy()
 
 
 class Gnss(CarlaSensor):
@@ -227,6 +422,8 @@ class Imu(CarlaSensor):
 
 
 class LaneInvasion(CarlaSensor):
+    OPTIONS = {'reducer': 'default'}
+
     def __init__(self, name, attributes, interface, parent):
         super().__init__(name, attributes, interface, parent)
 
@@ -238,18 +435,24 @@ class LaneInvasion(CarlaSensor):
         # sensor_data: [transform, lane marking]
         return [sensor_data.transform, sensor_data.crossed_lane_markings]
 
+    def reduce_events(self, events):
+        """Union of all the crossed lane markings, with the latest transform"""
+        markings, seen = [], set()
+        for _, crossed_lane_markings in events:
+            for marking in crossed_lane_markings:
+                key = (marking.type, marking.color, marking.lane_change)
+                if key not in seen:
+                    seen.add(key)
+                    markings.append(marking)
+        return [events[-1][0], markings]
+
 
 class Collision(CarlaSensor):
+    OPTIONS = {'reducer': 'default'}
+
     def __init__(self, name, attributes, interface, parent):
-        self._last_event_frame = 0
         super().__init__(name, attributes, interface, parent)
 
-    def callback(self, data):
-        # The collision sensor can have multiple callbacks per tick. Get only the first one
-        if self._last_event_frame != data.frame:
-            self._last_event_frame = data.frame
-            self.update_sensor(data, data.frame)
-
     def is_event_sensor(self):
         return True
 
@@ -261,8 +464,14 @@ class Collision(CarlaSensor):
         # [sensor_data.other_actor, impulse_value]
         return impulse_value
 
+    def reduce_events(self, events):
+        """The strongest impulse of the frame"""
+        return max(events)
+
 
 class Obstacle(CarlaSensor):
+    OPTIONS = {'reducer': 'default'}
+
     def __init__(self, name, attributes, interface, parent):
         super().__init__(name, attributes, interface, parent)
 
@@ -273,3 +482,7 @@ class Obstacle(CarlaSensor):
         """Parses the ObstacleDetectionEvent into a list"""
         # sensor_data: [other actor, distance]
         return [sensor_data.other_actor, sensor_data.distance]
+
+    def reduce_events(self, events):
+        """The closest obstacle of the frame"""
+        return min(events, key=lambda event: event[1])
@@ -6,21 +6,33 @@
 # This work is licensed under the terms of the MIT license.
 # For a copy, see <https://opensource.org/licenses/MIT>.
 
-import queue
+import threading
+import time
+from collections import defaultdict
 
 
 class SensorInterface(object):
     """
-    Class used to handle all the sensor data management
+    Class used to handle all the sensor data management. The data of each sensor is
+    kept in a slot keyed by the simulator frame it was produced at
     """
 
-    def __init__(self):
+    def __init__(self, max_pending_frames=32):
         self._sensors = {}  # {name: Sensor object}
-        self._data_buffers = queue.Queue()
+        self._event_sensors = {}
         self._queue_timeout = 10
 
-        self._event_sensors = {}
-        self._event_data_buffers = queue.Queue()
+        # {name: {frame: data}}
+        self._slots = defaultdict(dict)
+        self._slots_cv = threading.Condition()
+        self._max_pending_frames = max_pending_frames
+
+        # Data thrown away because it was older than the requested frame, and
+        # frames a sensor skipped
+        self.n_dropped = defaultdict(int)
+
+        # Sensors that skipped the frame of the last get_data call
+        self.missing = []
 
     @property
     def sensors(self):
@@ -31,8 +43,8 @@ class SensorInterface(object):
     def destroy(self):
         for sensor in self.sensors.values():
             sensor.destroy()
-        self._data_buffers = queue.Queue()
-        self._event_data_buffers = queue.Queue()
+        with self._slots_cv:
+            self._slots.clear()
 
     def register(self, name, sensor):
         """Adds a specific sensor to the class"""
@@ -41,25 +53,92 @@ class SensorInterface(object):
         else:
             self._sensors[name] = sensor
 
-    def get_data(self):
-        """Returns the data of all the registered sensors as a dictionary {sensor_name: sensor_data}"""
-        try:
-            data_dict = {}
-            while len(data_dict.keys()) < len(self._sensors.keys()):
-                sensor_data = self._data_buffers.get(True, self._queue_timeout)
-                # data_dict[sensor_data[0]] = (sensor_data[1], sensor_data[2])
-                data_dict[sensor_data[0]] = sensor_data[2]
-
-        except queue.Empty:
-            raise RuntimeError("A sensor took too long to send their data")
-
-        for event_sensor in self._event_sensors:
-            try:
-                sensor_data = self._event_data_buffers.get_nowait()
-                # data_dict[sensor_data[0]] = (sensor_data[1], sensor_data[2])
-                data_dict[sensor_data[0]] = sensor_data[2]
-            except queue.Empty:
-                pass
-        # print("Data buffer: {}".format(len(self._data_buffers.queue)))
-        # print("Event data buffer: {}".format(len(self._event_data_buffers.queue)))
+    def tick(self, frame):
+        """Lets the sensors computed on the client, which have no CARLA callback,
+        produce their data of the frame"""
+        for sensor in self.sensors.values():
+            sensor.tick(frame)
+
+    def put(self, name, frame, data):
+        """Stores the data a sensor produced at the given frame. Event sensors can
+        produce several events per frame, all of them are kept"""
+        with self._slots_cv:
+            slot = self._slots[name]
+            if name in self._event_sensors:
+                slot.setdefault(frame, []).append(data)
+            else:
+                slot[frame] = data
+
+            # Never let a sensor that is not being read build up a backlog
+            while len(slot) > self._max_pending_frames:
+                del slot[min(slot)]
+                self.n_dropped[name] += 1
+
+            self._slots_cv.notify_all()
+
+    def _drop_stale(self, name, frame):
+        """Removes the data older than the frame"""
+        slot = self._slots[name]
+        for f in [f for f in slot if f < frame]:
+            del slot[f]
+            self.n_dropped[name] += 1
+
+    def _latest_frame(self, name, frame=None):
+        frames = [f for f in self._slots[name] if frame is None or f <= frame]
+        return max(frames) if frames else None
+
+    def get_data(self, frame=None):
+        """Returns the data of all the registered sensors at the given frame as a
+        dictionary {sensor_name: sensor_data}. A sensor that skipped the frame is
+        left out, listed in missing and counted in n_dropped. Sensors with a sensor_tick return
+        their newest data without waiting for the frame. Event sensors return the
+        events up to the frame that were not returned yet, reduced by the sensor,
+        and are left out if there were none. If no frame is given, the newest data
+        of each sensor is returned"""
+        data_dict = {}
+        self.missing = []
+        deadline = time.monotonic() + self._queue_timeout
+
+        with self._slots_cv:
+            for name, sensor in self._sensors.items():
+                if sensor.sensor_tick > 0:
+                    continue
+
+                # Wait for the data of the frame, or for any data if there is no frame
+                while True:
+                    latest = self._latest_frame(name)
+                    if latest is not None and (frame is None or latest >= frame):
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RuntimeError("A sensor took too long to send their data")
+                    self._slots_cv.wait(remaining)
+
+                target = latest if frame is None else frame
+                self._drop_stale(name, target)
+                if target not in self._slots[name]:
+                    # The sensor skipped the frame, leave it out of this one
+                    self.missing.append(name)
+                    self.n_dropped[name] += 1
+                    continue
+                data_dict[name] = self._slots[name].pop(target)
+
+            # Sensors that are not expected to have data at every frame
+            for name, sensor in self._sensors.items():
+                target = self._latest_frame(name, frame)
+                if sensor.sensor_tick <= 0 or target is None:
+                    continue
+                # Keep it, it is still the newest data until the next sensor tick
+                self._drop_stale(name, target)
+                data_dict[name] = self._slots[name][target]
+
+            for name, sensor in self._event_sensors.items():
+                # Events that arrived after their frame was returned are reported
+                # now, late rather than never
+                slot = self._slots[name]
+                frames = sorted(f for f in slot if frame is None or f <= frame)
+                events = [event for f in frames for event in slot.pop(f)]
+                if events:
+                    data_dict[name] = sensor.reduce(events)
+
         return data_dict
@@ -67,3 +67,8 @@ class CarlaServer:
 
         sensor_data = self.core.tick(control)
         return sensor_data
+
+    def is_sensor_data_complete(self):
+        """False if a sensor skipped the frame of the last step, its data is then
+        missing from the sensor data"""
+        return not self.core.sensor_interface.missing
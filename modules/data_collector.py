@@ -122,9 +122,11 @@ class DataCollector:
             # Collect the data from agent
             data = self.agent_manager.collect_data(agent, self.pre_process)
 
-            # Write data at regular intervals
+            # Write data at regular intervals, a tick missing the data of a sensor
+            # would give a sample without its member
             if i % self.cfg['data_writer']['data_write_freq'] == 0:
-                self.writer.write(data, i)
+                if self.server.is_sensor_data_complete():
+                    self.writer.write(data, i)
 
             # Change the destination if done
             if agent.done():
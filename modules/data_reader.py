@@ -1,40 +1,514 @@
+import io
+import os
+import re
+import math
+import glob
+import json
+import mmap
+import queue
+import tarfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+
 import numpy as np
 import imageio as iio
+from PIL import Image as im
 
 from pathlib import Path
 
+import braceexpand
 import webdataset as wds
+from webdataset import autodecode, tariterators
+from webdataset.tariterators import base_plus_ext
 import torch
 
-from itertools import islice
-
 from utils import get_nonexistant_path
 
 
+def decode_raw(key, data):
+    """Decodes the members written with the 'raw' encoding of WebDatasetWriter"""
+    if key != 'raw' and not key.endswith('.raw'):
+        return None
+    header, _, buffer = data.partition(b'\n')
+    shape = tuple(int(dim) for dim in header.split(b',')) if header else ()
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(shape)
+
+
+def get_shard_paths(file_path):
+    """Returns the sorted shard paths of a tar file, a directory, a glob or brace
+    pattern, or a list of them"""
+    if isinstance(file_path, (list, tuple)):
+        return [path for item in file_path for path in get_shard_paths(item)]
+
+    file_path = str(file_path)
+    if os.path.isdir(file_path):
+        return sorted(glob.glob(os.path.join(file_path, '*.tar')))
+
+    paths = []
+    for pattern in braceexpand.braceexpand(file_path):
+        paths += sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    return paths
+
+
+def get_run_name(shard_path):
+    """Name of the collection run that wrote a shard, i.e. its file name without
+    the shard number"""
+    return re.sub(r'_\d{6}$', '', Path(shard_path).stem)
+
+
+def get_sample_position(sample):
+    """Returns the (run, shard number, key number) of a sample read by get_dataset,
+    the shard number is None for files that are not shards"""
+    stem = Path(sample['__url__']).stem
+    match = re.search(r'_(\d{6})$', stem)
+    shard = int(match.group(1)) if match else None
+    return get_run_name(sample['__url__']), shard, int(re.sub(r'\D', '', sample['__key__']))
+
+
+def expand_shards(sources):
+    """Expands the opened shards into samples, which keep the __url__ of their shard"""
+    for source in sources:
+        samples = tariterators.group_by_keys(
+            tariterators.tar_file_iterator(source['stream'])
+        )
+        for sample in samples:
+            sample['__url__'] = source['url']
+            yield sample
+
+
+def collate_samples(samples):
+    """Collates a list of sample dictionaries into a dictionary of batches"""
+    batch = {}
+    for key in samples[0]:
+        values = [sample[key] for sample in samples]
+        if isinstance(values[0], torch.Tensor):
+            batch[key] = torch.stack(values)
+        elif isinstance(values[0], np.ndarray):
+            batch[key] = np.stack(values)
+        else:
+            batch[key] = values
+    return batch
+
+
+class ImageTransform:
+    """Vectorized post processing of collated batches of uint8 images.
+
+    Images are decoded as uint8 (image_spec 'torchrgb8' or 'rgb8') and converted
+    to float only after collation, with the same gray scale weights and
+    normalization as core.helper.post_process_image. Accepts (..., C, H, W)
+    tensors or (..., H, W, C) arrays and returns (..., C, H, W) float tensors.
+    """
+
+    # Fixed point weights of cv2.COLOR_RGB2GRAY
+    GRAY_WEIGHTS = (4899 / 16384, 9617 / 16384, 1868 / 16384)
+
+    def __init__(self, normalized=True, gray_scale=True, size=None):
+        self.normalized = normalized
+        self.gray_scale = gray_scale
+        self.size = size
+
+    def __call__(self, images):
+        if isinstance(images, np.ndarray):
+            images = torch.from_numpy(images).movedim(-1, -3)
+        images = images.float()
+
+        if self.gray_scale:
+            weights = images.new_tensor(self.GRAY_WEIGHTS).view(3, 1, 1)
+            images = torch.floor((images * weights).sum(dim=-3, keepdim=True) + 0.5)
+
+        if self.size is not None:
+            shape = images.shape
+            images = torch.nn.functional.interpolate(
+                images.reshape((-1,) + shape[-3:]),
+                size=self.size,
+                mode='bilinear',
+                align_corners=False,
+            )
+            images = images.reshape(shape[:-2] + images.shape[-2:])
+
+        if self.normalized:
+            images = (images - 128) / 128
+        return images
+
+
+class MetadataFilter:
+    """Predicate evaluated on the json member of a sample before anything is decoded.
+
+    Every condition is a field of the json member and either a value to compare
+    with, a list of accepted values or a callable, e.g.
+    MetadataFilter(collision=True, speed=lambda speed: speed > 5). A predicate
+    taking the whole json dictionary can be given too.
+    """
+
+    def __init__(self, predicate=None, **conditions):
+        self.predicate = predicate
+        self.conditions = conditions
+
+    def matches(self, metadata):
+        for field, condition in self.conditions.items():
+            if field not in metadata:
+                return False
+            value = metadata[field]
+            if callable(condition):
+                matched = condition(value)
+            elif isinstance(condition, (list, tuple, set)):
+                matched = value in condition
+            else:
+                matched = value == condition
+            if not matched:
+                return False
+        return self.predicate is None or self.predicate(metadata)
+
+    def __call__(self, sample):
+        return self.matches(json.loads(sample['json']))
+
+
+class SequenceBuffer:
+    """Fixed ring buffer holding the last frames of a stream of samples.
+
+    Tensors and arrays are copied into preallocated storage and a window is
+    stacked with a single index operation per key, other values are returned as
+    lists. With a dilation of N the window holds every Nth frame. All the samples
+    must have the same keys and shapes.
+    """
+
+    def __init__(self, length, dilation=1):
+        self.length = length
+        self.dilation = dilation
+        self.span = (length - 1) * dilation + 1
+        self.count = 0
+        self.storage = None
+        self._window_slots = {}
+
+    def _allocate(self, sample):
+        self.storage = {}
+        for key, value in sample.items():
+            if isinstance(value, torch.Tensor):
+                self.storage[key] = value.new_empty((self.span,) + tuple(value.shape))
+            elif isinstance(value, np.ndarray):
+                self.storage[key] = np.empty(
+                    (self.span,) + value.shape, dtype=value.dtype
+                )
+            else:
+                self.storage[key] = [None] * self.span
+
+    def append(self, sample):
+        if self.storage is None:
+            self._allocate(sample)
+        slot = self.count % self.span
+        for key, store in self.storage.items():
+            store[slot] = sample[key]
+        self.count += 1
+
+    def is_full(self):
+        return self.count >= self.span
+
+    def reset(self):
+        """Starts a new stream, the storage is kept"""
+        self.count = 0
+
+    def _get_slots(self):
+        newest = (self.count - 1) % self.span
+        if newest not in self._window_slots:
+            slots = [
+                (newest - self.dilation * i) % self.span
+                for i in reversed(range(self.length))
+            ]
+            self._window_slots[newest] = (slots, torch.tensor(slots))
+        return self._window_slots[newest]
+
+    def window(self):
+        """Returns the frames of the window stacked per key, oldest first"""
+        slots, slots_tensor = self._get_slots()
+        window = {}
+        for key, store in self.storage.items():
+            if isinstance(store, torch.Tensor):
+                window[key] = store.index_select(0, slots_tensor.to(store.device))
+            elif isinstance(store, np.ndarray):
+                window[key] = store.take(slots, axis=0)
+            else:
+                window[key] = [store[slot] for slot in slots]
+        return window
+
+
+def build_shard_index(shard_path):
+    """Scans an uncompressed tar file and returns the index written by
+    WebDatasetWriter, including every scalar field of the json members"""
+    samples = {}
+    with tarfile.open(shard_path, mode='r:') as tar:
+        for member in tar:
+            key, suffix = base_plus_ext(member.name)
+            if key is None:
+                continue
+            end = member.offset_data + -(-member.size // tarfile.BLOCKSIZE) * (
+                tarfile.BLOCKSIZE
+            )
+            entry = samples.setdefault(key, {'offset': member.offset})
+            entry['length'] = end - entry['offset']
+
+            if suffix == 'json':
+                metadata = json.loads(tar.extractfile(member).read())
+                for field, value in metadata.items():
+                    if isinstance(value, (bool, int, float, str)):
+                        entry[field] = value
+    return {'compressed': False, 'samples': samples}
+
+
+def load_shard_index(shard_path):
+    """Loads the index of a shard, building and saving it when there is none"""
+    index_path = shard_path + '.index.json'
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as fp:
+            index = json.load(fp)
+    else:
+        with open(shard_path, 'rb') as fp:
+            if fp.read(2) == b'\x1f\x8b':
+                index = {'compressed': True}
+            else:
+                index = build_shard_index(shard_path)
+                try:
+                    with open(index_path, 'w') as fp:
+                        json.dump(index, fp)
+                except OSError:
+                    pass
+
+    if index['compressed']:
+        raise ValueError(
+            '{} is compressed and cannot be read by seeking, write the data with '
+            'compress: False'.format(shard_path)
+        )
+    return index
+
+
+class IndexedWebDataset(torch.utils.data.Dataset):
+    """Map-style dataset over the shards written by WebDatasetWriter.
+
+    A sample is fetched either by its global index or by its (run, __key__), by
+    reading its bytes from the memory-mapped shard at the offset stored in the
+    shard index. The keys start again in every collection run, so the __key__
+    alone is only accepted when all the shards belong to a single run.
+    """
+
+    def __init__(self, file_path, image_spec='torchrgb'):
+        self.shard_paths = get_shard_paths(file_path)
+        self.decoder = autodecode.Decoder(
+            [decode_raw, autodecode.ImageHandler(image_spec)]
+        )
+
+        # Flat table of (shard, key, entry) over all the shards
+        self.samples = []
+        for shard_id, shard_path in enumerate(self.shard_paths):
+            index = load_shard_index(shard_path)
+            for key, entry in index['samples'].items():
+                self.samples.append((shard_id, key, entry))
+
+        # {(run, key): index}, see get_run_name
+        self.runs = sorted(set(get_run_name(path) for path in self.shard_paths))
+        self.key_to_index = {}
+        for i, (shard_id, key, _) in enumerate(self.samples):
+            run_key = (get_run_name(self.shard_paths[shard_id]), key)
+            if run_key in self.key_to_index:
+                raise ValueError('Sample {} is in several shards'.format(run_key))
+            self.key_to_index[run_key] = i
+        self._mmaps = {}
+
+    def __getstate__(self):
+        # Memory maps are opened again by every DataLoader worker
+        state = self.__dict__.copy()
+        state['_mmaps'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _get_mmap(self, shard_id):
+        if shard_id not in self._mmaps:
+            with open(self.shard_paths[shard_id], 'rb') as fp:
+                self._mmaps[shard_id] = mmap.mmap(
+                    fp.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return self._mmaps[shard_id]
+
+    def read_sample(self, index):
+        """Returns the undecoded sample at a global index"""
+        shard_id, key, entry = self.samples[index]
+        buffer = self._get_mmap(shard_id)[
+            entry['offset'] : entry['offset'] + entry['length']
+        ]
+
+        sample = {'__key__': key}
+        with tarfile.open(fileobj=io.BytesIO(buffer), mode='r:') as tar:
+            for member in tar:
+                _, suffix = base_plus_ext(member.name)
+                sample[suffix.lower()] = tar.extractfile(member).read()
+        return sample
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            if len(self.runs) != 1:
+                raise KeyError(
+                    'The shards belong to several runs, use a (run, key) tuple'
+                )
+            item = (self.runs[0], item)
+        if isinstance(item, tuple):
+            item = self.key_to_index[item]
+        return self.decoder(self.read_sample(item))
+
+    def filter(self, predicate=None, **conditions):
+        """Returns the subset of samples that satisfy a MetadataFilter. The fields
+        stored in the shard indexes are used directly, the json member of a sample
+        is only read when the filter needs other fields"""
+        metadata_filter = MetadataFilter(predicate, **conditions)
+        indexed_only = predicate is None
+
+        indices = []
+        for i, (_, _, entry) in enumerate(self.samples):
+            if indexed_only and all(field in entry for field in conditions):
+                matched = metadata_filter.matches(entry)
+            else:
+                matched = metadata_filter(self.read_sample(i))
+            if matched:
+                indices.append(i)
+        return torch.utils.data.Subset(self, indices)
+
+    def close(self):
+        for shard_mmap in self._mmaps.values():
+            shard_mmap.close()
+        self._mmaps = {}
+
+
+def group_shards_by_run(shard_paths):
+    """Groups the shards written by one collection run, i.e. the shards whose
+    names only differ by the shard number"""
+    runs = defaultdict(list)
+    for shard_path in shard_paths:
+        runs[get_run_name(shard_path)].append(shard_path)
+    return dict(runs)
+
+
 class Replay:
-    def __init__(self, config):
+    _END = object()
+
+    # Members the rgb camera can be written to, see WebDatasetWriter.encodings
+    RGB_MEMBERS = ['jpeg', 'png', 'npy', 'raw']
+
+    def __init__(self, config, queue_size=64):
         self.cfg = config
         self.n_collision = 0
+        self.queue_size = queue_size
 
     def _get_unique_name(self, file_name, write_path):
         fname_path = Path(write_path, file_name).with_suffix('.mp4')
         save_path = get_nonexistant_path(fname_path=fname_path)
         return save_path
 
+    def _run_stage(self, fn, source, sink, stop, errors):
+        """Applies fn to every item of the source and puts the results in the sink,
+        until the source is exhausted or the pipeline is stopped"""
+        try:
+            for item in source:
+                if stop.is_set() or not self._put(sink, fn(item), stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self._put(sink, self._END, stop)
+
+    def _put(self, sink, item, stop):
+        # Nothing may read the sink any more once the pipeline is stopped
+        while not stop.is_set():
+            try:
+                sink.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _iter_queue(self, source, stop):
+        while not stop.is_set():
+            try:
+                item = source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self._END:
+                return
+            yield item
+
+    def _decode_frame(self, sample):
+        # The rgb member is named after its encoding in WebDatasetWriter
+        name = next((name for name in self.RGB_MEMBERS if name in sample), None)
+        if name is None:
+            raise KeyError('Sample {} has no rgb member'.format(sample['__key__']))
+
+        if name == 'npy':
+            return np.load(io.BytesIO(sample[name]), allow_pickle=False)
+        elif name == 'raw':
+            return decode_raw(name, sample[name])
+
+        # Decode the image bytes straight to uint8
+        with im.open(io.BytesIO(sample[name])) as image:
+            return np.asarray(image.convert('RGB'))
+
+    def _transform_frame(self, frame):
+        # Rotate the frames of the rolled camera back to an upright view
+        return np.ascontiguousarray(np.rot90(frame))
+
     def _create_movie(self, samples, file_name, write_path):
+        """Writes the undecoded samples into a movie. Decoding, transforming and
+        encoding run as separate stages connected by bounded queues"""
         save_path = self._get_unique_name(file_name, write_path)
         writer = iio.get_writer(save_path, format='FFMPEG', mode='I', codec='mpeg4')
 
-        for i, sample in enumerate(samples):
-            if type(sample['jpeg']) is list:
-                array = torch.stack(sample['jpeg'], dim=0).cpu().detach().numpy()
-            else:
-                array = sample['jpeg'].cpu().detach().numpy()
-            array = np.swapaxes(array, 0, 2) * 255  # Scaling co-efficient
+        errors = []
+        stop = Event()
+        decoded = queue.Queue(maxsize=self.queue_size)
+        transformed = queue.Queue(maxsize=self.queue_size)
+        stages = [
+            Thread(
+                target=self._run_stage,
+                args=(self._decode_frame, samples, decoded, stop, errors),
+                daemon=True,
+            ),
+            Thread(
+                target=self._run_stage,
+                args=(
+                    self._transform_frame,
+                    self._iter_queue(decoded, stop),
+                    transformed,
+                    stop,
+                    errors,
+                ),
+                daemon=True,
+            ),
+        ]
+        for stage in stages:
+            stage.start()
 
-            # Write the array
-            writer.append_data(np.flipud(array).astype(np.uint8))
-        writer.close()
+        # Write the frames, any failure stops all the stages
+        try:
+            for frame in self._iter_queue(transformed, stop):
+                writer.append_data(frame)
+        finally:
+            stop.set()
+            for stage in stages:
+                stage.join()
+            writer.close()
+
+        if errors:
+            raise errors[0]
+        return save_path
+
+    def create_movies(self, runs, write_path, max_workers=4):
+        """Exports one movie per run concurrently, runs maps the movie file names
+        to their undecoded samples"""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self._create_movie, samples, file_name, write_path)
+                for file_name, samples in runs.items()
+            ]
+            return [future.result() for future in futures]
 
 
 class WebDatasetReader:
@@ -44,48 +518,157 @@ class WebDatasetReader:
         self.replay = Replay(config)
         self.sink = None
 
-    def _concatenate_samples(self, samples):
-        combined_data = {
-            k: [d.get(k) for d in samples if k in d] for k in set().union(*samples)
-        }
-        return combined_data
+    def _continues(self, previous, position, step):
+        """True if the sample at position directly follows the previous one, i.e.
+        same run, same or next shard and the same key step"""
+        if previous is None or position[0] != previous[0]:
+            return False
+        shard, previous_shard = position[1], previous[1]
+        if shard != previous_shard and (
+            shard is None or previous_shard is None or shard != previous_shard + 1
+        ):
+            return False
+        index_step = position[2] - previous[2]
+        return index_step > 0 and (step is None or index_step == step)
+
+    def _generate_seqs(self, src, nsamples=3, stride=1, dilation=1):
+        # Windows never span two runs, shards that are not adjacent, e.g. when the
+        # shards are split between workers, or samples missing from the shards
+        buffer = SequenceBuffer(nsamples, dilation=dilation)
+        previous, step = None, None
+        for sample in src:
+            position = get_sample_position(sample)
+            if self._continues(previous, position, step):
+                step = position[2] - previous[2]
+            else:
+                buffer.reset()
+                step = None
+            previous = position
 
-    def _generate_seqs(self, src, nsamples=3):
-        it = iter(src)
-        result = tuple(islice(it, nsamples))
-        if len(result) == nsamples:
-            yield self._concatenate_samples(result)
-        for elem in it:
-            result = result[1:] + (elem,)
-            yield self._concatenate_samples(result)
+            buffer.append(sample)
+            if buffer.is_full() and (buffer.count - buffer.span) % stride == 0:
+                yield buffer.window()
 
-    def create_movie(self, file_name=None, write_path=None):
-        # Get the samples
-        samples = self.get_dataset()
+    def create_movie(self, file_name=None, write_path=None, max_workers=4):
+        # One movie per collection run, unless a file name is given
+        shard_paths = get_shard_paths(self.file_path)
+        if file_name is None:
+            runs = group_shards_by_run(shard_paths)
+        else:
+            runs = {file_name: shard_paths}
 
         if write_path is None:
-            write_path = Path(self.file_path).parent
+            write_path = Path(shard_paths[0]).parent
 
-        if file_name is None:
-            file_name = Path(self.file_path).stem
+        # Get the undecoded samples
+        runs = {
+            name: wds.WebDataset(paths, shardshuffle=False)
+            for name, paths in runs.items()
+        }
+        return self.replay.create_movies(runs, write_path, max_workers=max_workers)
+
+    def get_dataset(
+        self,
+        concat_n_samples=None,
+        metadata_filter=None,
+        stride=1,
+        dilation=1,
+        image_spec="torchrgb",
+        shuffle_buffer=0,
+        shuffle_shards=False,
+    ):
+        # The shards are split between the nodes and then between the workers
+        dataset = (
+            wds.ShardList(get_shard_paths(self.file_path), shuffle=shuffle_shards)
+            .then(tariterators.url_opener)
+            .then(expand_shards)
+        )
 
-        self.replay._create_movie(samples, file_name, write_path)
+        # Filter on the json member before decoding the images
+        if metadata_filter is not None:
+            dataset = dataset.select(metadata_filter)
 
-    def get_dataset(self, concat_n_samples=None):
+        # Shuffle the undecoded samples, sequences are shuffled once built
         if concat_n_samples is None:
-            dataset = wds.WebDataset(self.file_path).decode("torchrgb")
-        else:
-            dataset = (
-                wds.WebDataset(self.file_path)
-                .decode("torchrgb")
-                .then(self._generate_seqs, concat_n_samples)
-            )
+            dataset = dataset.shuffle(shuffle_buffer)
+
+        # 'torchrgb8' or 'rgb8' keep the images as uint8, see ImageTransform
+        dataset = dataset.decode(decode_raw, image_spec)
+        if concat_n_samples is not None:
+            dataset = dataset.then(
+                self._generate_seqs, concat_n_samples, stride=stride, dilation=dilation
+            ).shuffle(shuffle_buffer)
         return dataset
 
-    def get_dataloader(self, num_workers, batch_size, concat_n_samples=None):
+    def estimate_length(self):
+        """Returns the number of samples read by this node, counted from the shard
+        indexes, or None if a shard has no index"""
+        n_samples = 0
+        for shard_path in get_shard_paths(self.file_path):
+            index_path = shard_path + '.index.json'
+            if not os.path.isfile(index_path):
+                return None
+            with open(index_path, 'r') as fp:
+                n_samples += len(json.load(fp)['samples'])
+
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            n_samples //= torch.distributed.get_world_size()
+        return n_samples
+
+    def filter(self, predicate=None, concat_n_samples=None, **conditions):
+        """Returns the dataset of the samples that satisfy a MetadataFilter"""
+        return self.get_dataset(
+            concat_n_samples=concat_n_samples,
+            metadata_filter=MetadataFilter(predicate, **conditions),
+        )
+
+    def get_indexed_dataset(self, image_spec='torchrgb'):
+        """Returns a map-style dataset to access the samples by index or key"""
+        return IndexedWebDataset(self.file_path, image_spec=image_spec)
+
+    def get_dataloader(
+        self,
+        num_workers,
+        batch_size,
+        concat_n_samples=None,
+        metadata_filter=None,
+        stride=1,
+        dilation=1,
+        image_spec="torchrgb",
+        shuffle_buffer=0,
+        shuffle_shards=False,
+        prefetch_factor=2,
+        transform=None,
+    ):
         # Get the dataset
-        dataset = self.get_dataset(concat_n_samples=concat_n_samples)
+        dataset = self.get_dataset(
+            concat_n_samples=concat_n_samples,
+            metadata_filter=metadata_filter,
+            stride=stride,
+            dilation=dilation,
+            image_spec=image_spec,
+            shuffle_buffer=shuffle_buffer,
+            shuffle_shards=shuffle_shards,
+        )
+        dataset = dataset.batched(batch_size, collation_fn=collate_samples)
+
+        # Post processing of the collated batches {member: fn}, e.g. uint8 images
+        # normalized with {'jpeg': ImageTransform()} and image_spec 'torchrgb8'
+        if transform is not None:
+            dataset = dataset.map_dict(**transform)
+
+        # Number of batches estimated from the shard indexes, unknown once filtered
+        n_samples = self.estimate_length() if metadata_filter is None else None
+        if n_samples is not None:
+            if concat_n_samples is not None:
+                n_samples = n_samples // stride
+            dataset = wds.Processor(
+                dataset, wds.utils.identity, length=math.ceil(n_samples / batch_size)
+            )
+
+        # Batches prefetched by each worker
+        options = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
         dataloader = torch.utils.data.DataLoader(
-            dataset.batched(batch_size), num_workers=num_workers, batch_size=None
+            dataset, num_workers=num_workers, batch_size=None, **options
         )
         return dataloader
@@ -1,35 +1,468 @@
+import io
 import os
 import json
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 from PIL import Image as im
 
+try:
+    import msgpack
+except ModuleNotFoundError:
+    msgpack = None
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
 import webdataset as wds
 
+from core.sensors.sensor import BaseCamera, materialize
 from utils import get_nonexistant_shard_path, get_nonexistant_path
 
 
-class WebDatasetWriter:
-    def __init__(self, config) -> None:
-        self.cfg = config
-        self.sink = None
+def encode_image(array, extension='jpeg'):
+    """Encodes an image array into bytes with the same settings as webdataset"""
+    image_format = 'JPEG' if extension in ['jpg', 'jpeg'] else extension.upper()
+    options = dict(quality=100) if image_format == 'JPEG' else {}
+    with io.BytesIO() as result:
+        im.fromarray(array).save(result, format=image_format, **options)
+        return result.getvalue()
+
+
+def encode_npy(array):
+    """Encodes an array in the numpy .npy format"""
+    with io.BytesIO() as result:
+        np.save(result, np.asarray(array), allow_pickle=False)
+        return result.getvalue()
+
+
+def encode_raw(array):
+    """Encodes a uint8 array as a comma separated shape header line followed by the raw bytes"""
+    array = np.asarray(array)
+    if array.dtype != np.uint8:
+        message = 'The raw encoding only stores uint8 arrays, not {}, use npy instead'
+        raise ValueError(message.format(array.dtype))
+    array = np.ascontiguousarray(array)
+    header = ','.join(str(dim) for dim in array.shape) + '\n'
+    return header.encode('ascii') + array.tobytes()
+
+
+def _to_builtin(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Object of type {} cannot be packed'.format(type(value).__name__))
+
+
+def encode_msgpack(value):
+    """Encodes nested lists, dicts, numbers and arrays with msgpack"""
+    if msgpack is None:
+        raise ModuleNotFoundError('The msgpack encoding requires the msgpack package')
+    return msgpack.packb(value, default=_to_builtin)
+
+
+ENCODINGS = ['jpeg', 'png', 'npy', 'raw', 'msgpack']
+
+
+def is_plain(value):
+    """True for arrays, numbers, strings and containers of them. Other objects, e.g.
+    carla objects, cannot be written to a sample anyway"""
+    if isinstance(value, np.ndarray):
+        return value.dtype != object
+    if isinstance(value, (np.generic, bool, int, float, str, bytes, type(None))):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(is_plain(v) for v in value)
+    if isinstance(value, dict):
+        return all(is_plain(k) and is_plain(v) for k, v in value.items())
+    return False
+
+
+def encode_member(value, encoding):
+    """Encodes a sample member into bytes with one of the ENCODINGS"""
+    if encoding in ['jpeg', 'png']:
+        return encode_image(value, encoding)
+    elif encoding == 'npy':
+        return encode_npy(value)
+    elif encoding == 'raw':
+        return encode_raw(value)
+    elif encoding == 'msgpack':
+        return encode_msgpack(value)
+    raise ValueError('Unknown encoding {}'.format(encoding))
+
+
+class JsonSerializer:
+    """Serializes the json member of the samples in a single pass.
+
+    How each key is converted is learned the first time the key is seen: json
+    values are kept as they are, numpy scalars and small arrays are converted to
+    python objects and everything else is dropped. Arrays larger than
+    max_array_size are dropped too. orjson is used when available.
+    """
+
+    NATIVE, NUMPY_SCALAR, NUMPY_ARRAY, SKIP = range(4)
+
+    def __init__(self, max_array_size=64):
+        self.max_array_size = max_array_size
+        self.schema = {}
 
     def _is_jsonable(self, x):
         try:
             json.dumps(x)
             return True
-        except (TypeError, OverflowError):
+        except (TypeError, OverflowError, ValueError):
             return False
 
-    def _get_serializable_data(self, data):
-        keys_to_delete = []
+    def _classify(self, value):
+        if isinstance(value, np.generic):
+            return self.NUMPY_SCALAR
+        if isinstance(value, np.ndarray):
+            # Larger arrays need an entry in the encodings of the data writer
+            if value.size <= self.max_array_size and self._is_jsonable(value.tolist()):
+                return self.NUMPY_ARRAY
+            return self.SKIP
+        if self._is_jsonable(value):
+            return self.NATIVE
+        return self.SKIP
+
+    def _convert(self, data):
+        result = {}
         for key, value in data.items():
-            if not self._is_jsonable(value):
-                keys_to_delete.append(key)
-        for key in keys_to_delete:
-            del data[key]
-        return data
+            kind = self.schema.get(key)
+            if kind is None:
+                kind = self.schema[key] = self._classify(value)
+
+            if kind == self.NATIVE:
+                result[key] = value
+            elif kind == self.NUMPY_SCALAR:
+                result[key] = value.item()
+            elif kind == self.NUMPY_ARRAY and value.size <= self.max_array_size:
+                result[key] = value.tolist()
+        return result
+
+    def _dumps(self, data):
+        if orjson is not None:
+            try:
+                return orjson.dumps(data)
+            except TypeError:
+                # orjson rejects some json values, e.g. int keys or ints above 64 bits
+                pass
+        return json.dumps(data).encode('utf-8')
+
+    def serialize(self, data):
+        """Returns the json bytes of the serializable part of the data"""
+        try:
+            return self._dumps(self._convert(data))
+        except (TypeError, OverflowError, ValueError, AttributeError):
+            # The type of some value changed, learn the schema again
+            self.schema = {}
+            return self._dumps(self._convert(data))
+
+
+class EncoderPool:
+    """Encodes the sample members concurrently while keeping the samples in key order"""
+
+    def __init__(self, size=4, kind='thread'):
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=size)
+        elif kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=size)
+        else:
+            raise ValueError('Unknown encoder pool type {}'.format(kind))
+
+        # Bound the number of samples in flight
+        self.max_pending = 2 * size
+        self._pending = deque()
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def _is_done(self, sample):
+        return all(v.done() for v in sample.values() if isinstance(v, Future))
+
+    def _resolve(self, sample):
+        return {
+            k: v.result() if isinstance(v, Future) else v for k, v in sample.items()
+        }
+
+    def put(self, sample):
+        """Queues a sample, whose members can be futures, and yields the samples
+        that are ready to be written, in the order they were queued. A sample whose
+        encoding failed stays queued, so it raises again instead of leaving a hole"""
+        self._pending.append(sample)
+        while self._pending and (
+            len(self._pending) > self.max_pending or self._is_done(self._pending[0])
+        ):
+            ready = self._resolve(self._pending[0])
+            self._pending.popleft()
+            yield ready
+
+    def flush(self):
+        """Waits for all the queued samples and yields them in order"""
+        while self._pending:
+            ready = self._resolve(self._pending[0])
+            self._pending.popleft()
+            yield ready
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class IndexedTarWriter(wds.TarWriter):
+    """TarWriter that writes an index next to the tar file when it is closed.
+
+    The index, '<tar file>.index.json', maps every __key__ to the byte offset and
+    length of the sample in the uncompressed tar stream, together with a few
+    scalar fields of its json member. The offsets can only be used for seeking
+    when the tar file is not compressed.
+    """
+
+    def __init__(self, fname, index_fields=(), **kw):
+        super().__init__(fname, **kw)
+        self.index_path = fname + '.index.json'
+        self.index_fields = index_fields
+        self.samples = {}
+
+    def write(self, obj):
+        offset = self.tarstream.offset
+        super().write(obj)
+        length = self.tarstream.offset - offset
+
+        entry = {'offset': offset, 'length': length}
+        if self.index_fields and 'json' in obj:
+            metadata = json.loads(obj['json'])
+            for field in self.index_fields:
+                if field in metadata:
+                    entry[field] = metadata[field]
+        self.samples[obj['__key__']] = entry
+        return length
+
+    def close(self):
+        super().close()
+        with open(self.index_path, 'w') as fp:
+            json.dump({'compressed': bool(self.compress), 'samples': self.samples}, fp)
+
+
+class IndexedShardWriter(wds.ShardWriter):
+    """ShardWriter that rolls over on the sample count or the byte budget of a
+    shard and writes an index for each shard"""
+
+    def next_stream(self):
+        self.finish()
+        self.fname = self.pattern % self.shard
+        if self.verbose:
+            print(
+                "# writing",
+                self.fname,
+                self.count,
+                "%.1f GB" % (self.size / 1e9),
+                self.total,
+            )
+        self.shard += 1
+        self.tarstream = IndexedTarWriter(self.fname, **self.kw)
+        self.count = 0
+        self.size = 0
+
+
+class BackgroundWriter:
+    """Hands the samples to a dedicated writer thread through a bounded queue.
+
+    The backpressure policy decides what happens when the queue is full:
+    'block' waits for the writer thread, 'drop_oldest' discards the oldest
+    queued sample and 'spill' pickles the sample to disk until the writer
+    thread catches up. prepare_spill is applied to the items before they are
+    pickled. The first error stops the writing, it is raised again by every
+    following put and by close.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        write_fn,
+        queue_size=64,
+        backpressure='block',
+        spill_dir=None,
+        prepare_spill=None,
+    ):
+        if backpressure not in ['block', 'drop_oldest', 'spill']:
+            raise ValueError('Unknown backpressure policy {}'.format(backpressure))
+
+        self.write_fn = write_fn
+        self.backpressure = backpressure
+        self.spill_dir = spill_dir
+        self.prepare_spill = prepare_spill
+        self.n_dropped = 0
+        self.n_spilled = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._spilled = deque()
+        self._spill_lock = threading.Lock()
+        self._spill_dir = None
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _spill(self, item):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='spill_', dir=self.spill_dir)
+        path = os.path.join(self._spill_dir, '%012d.pkl' % self.n_spilled)
+        if self.prepare_spill is not None:
+            item = self.prepare_spill(*item)
+        with open(path, 'wb') as fp:
+            pickle.dump(item, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spilled.append(path)
+        self.n_spilled += 1
+
+    def _unspill(self):
+        with self._spill_lock:
+            if not self._spilled:
+                return None
+            path = self._spilled.popleft()
+        with open(path, 'rb') as fp:
+            item = pickle.load(fp)
+        os.remove(path)
+        return item
+
+    def _write(self, item):
+        # After a failure the samples are discarded, the shard must not have holes
+        if self._error is not None:
+            return
+        try:
+            self.write_fn(*item)
+        except Exception as e:
+            # Raised again on the calling thread by every following put and close
+            self._error = e
+
+    def _next_item(self):
+        # Queued samples are always older than the spilled ones
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        item = self._unspill()
+        if item is not None:
+            return item
+        try:
+            return self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return None
+
+    def _run(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                continue
+
+            if item is self._STOP:
+                item = self._unspill()
+                while item is not None:
+                    self._write(item)
+                    item = self._unspill()
+                return
+            self._write(item)
+
+    def _raise_on_error(self):
+        if self._error is not None:
+            raise RuntimeError('The background writer failed') from self._error
+
+    def put(self, *item):
+        self._raise_on_error()
+
+        if self.backpressure == 'block':
+            self._queue.put(item)
+
+        elif self.backpressure == 'drop_oldest':
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.n_dropped += 1
+                    except queue.Empty:
+                        pass
+
+        else:
+            with self._spill_lock:
+                # Once spilling has started, keep spilling to preserve the order
+                if self._spilled:
+                    self._spill(item)
+                    return
+                try:
+                    self._queue.put_nowait(item)
+                except queue.Full:
+                    self._spill(item)
+
+    def close(self):
+        """Drains the queue and the spilled samples and stops the writer thread"""
+        try:
+            self._queue.put(self._STOP)
+            self._thread.join()
+        finally:
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+        self._raise_on_error()
+
+
+class WebDatasetWriter:
+    def __init__(self, config) -> None:
+        self.cfg = config
+        self.sink = None
+        self.background_writer = None
+        self.encoder_pool = None
+        self.serializer = JsonSerializer()
+
+        # Sensor data stored natively, everything else goes to the json member
+        self.encodings = self.cfg['data_writer'].get('encodings', {'rgb': 'jpeg'})
+        self._check_ring_buffers()
+        for key, encoding in self.encodings.items():
+            if encoding not in ENCODINGS:
+                raise ValueError('Unknown encoding {} for {}'.format(encoding, key))
+            if encoding == 'msgpack' and msgpack is None:
+                message = 'The msgpack encoding of {} requires the msgpack package'
+                raise ModuleNotFoundError(message.format(key))
+
+    def _check_ring_buffers(self):
+        """Sensors with copy: False return views into a ring of buffer_size arrays,
+        which must not be reused while their samples wait to be encoded or written"""
+        writer_cfg = self.cfg['data_writer']
+        depth = 1
+        if writer_cfg.get('async_write', False):
+            depth += writer_cfg.get('write_queue_size', 64)
+        depth += 2 * writer_cfg.get('encoder_pool_size', 0)
+
+        # The ring moves on every tick, not only the written ones
+        depth *= writer_cfg.get('data_write_freq', 1)
+
+        sensors = self.cfg.get('vehicle', {}).get('sensors') or {}
+        for name, attributes in sensors.items():
+            if attributes.get('copy', True):
+                continue
+            size = int(attributes.get('buffer_size', BaseCamera.OPTIONS['buffer_size']))
+            if size < depth:
+                message = (
+                    'Sensor {} reuses its outputs after {} frames but they can wait '
+                    '{} frames to be written, use copy: True or a larger buffer_size'
+                )
+                raise ValueError(message.format(name, size, depth))
 
     def create_tar_file(self, file_name, write_path):
+        # Finish the previous tar file before opening a new one
+        if self.sink is not None:
+            self.close()
+
         # Check if file already exists, increment if so
         if self.cfg['data_writer']['shard_write']:
             path_to_file = write_path + file_name + '_%06d.tar'
@@ -41,30 +474,106 @@ class WebDatasetWriter:
         write_path = get_nonexistant_path(path_to_file)
 
         # Create a tar file
+        compress = self.cfg['data_writer'].get('compress', True)
+        index_fields = self.cfg['data_writer'].get('index_fields', [])
         if self.cfg['data_writer']['shard_write']:
-            max_count = self.cfg['data_writer']['shard_maxcount']
-            self.sink = wds.ShardWriter(write_path, maxcount=max_count, compress=True)
+            self.sink = IndexedShardWriter(
+                write_path,
+                maxcount=self.cfg['data_writer']['shard_maxcount'],
+                maxsize=self.cfg['data_writer'].get('shard_maxsize', 3e9),
+                compress=compress,
+                index_fields=index_fields,
+            )
         else:
-            self.sink = wds.TarWriter(write_path, compress=True)
+            self.sink = IndexedTarWriter(
+                write_path, compress=compress, index_fields=index_fields
+            )
+
+        # Encode the images of several samples at the same time
+        pool_size = self.cfg['data_writer'].get('encoder_pool_size', 0)
+        if pool_size > 0:
+            self.encoder_pool = EncoderPool(
+                pool_size, self.cfg['data_writer'].get('encoder_pool_type', 'thread')
+            )
+
+        # Move the encoding and writing off the simulation thread
+        if self.cfg['data_writer'].get('async_write', False):
+            self.background_writer = BackgroundWriter(
+                self._write,
+                queue_size=self.cfg['data_writer'].get('write_queue_size', 64),
+                backpressure=self.cfg['data_writer'].get('write_backpressure', 'block'),
+                spill_dir=os.path.dirname(write_path) or None,
+                prepare_spill=self._prepare_spill,
+            )
+
+    def _encode(self, fn, *args):
+        if self.encoder_pool is not None:
+            return self.encoder_pool.submit(fn, *args)
+        return fn(*args)
+
+    def _prepare_spill(self, data, index):
+        # Lazy sensor data holds the sensor and cannot be pickled, neither can carla
+        # objects such as the lane invasion transform, which are never written
+        data = materialize(data)
+        return {key: value for key, value in data.items() if is_plain(value)}, index
+
+    def _member_name(self, key, encoding):
+        # The rgb camera keeps the layout read by WebDatasetReader and Replay
+        if key == 'rgb':
+            return encoding
+        return key + '.' + encoding
 
     def sample(self, data, index):
-        image_data = im.fromarray(data['rgb'])
-        del data['rgb']  # No longer needed
+        sample = {"__key__": "sample%06d" % index}
+
+        # Parse the lazy sensor data, only the written ticks pay for it
+        data = materialize(data)
+
+        # Encode the data which has its own encoding
+        for key, encoding in self.encodings.items():
+            if key in data:
+                name = self._member_name(key, encoding)
+                sample[name] = self._encode(encode_member, data.pop(key), encoding)
 
         # Find only serializable data
-        remaining_data = self._get_serializable_data(data)
-        return {
-            "__key__": "sample%06d" % index,
-            'jpeg': image_data,
-            'json': remaining_data,
-        }
+        sample['json'] = self.serializer.serialize(data)
+        return sample
+
+    def _write(self, data, index):
+        sample = self.sample(data, index)
+        if self.encoder_pool is None:
+            self.sink.write(sample)
+        else:
+            for ready_sample in self.encoder_pool.put(sample):
+                self.sink.write(ready_sample)
 
     def write(self, data, index):
         if self.sink is None:
             raise FileNotFoundError(
                 'Please call create_tar_file() method before calling the write method'
             )
-        self.sink.write(self.sample(data, index))
+        if self.background_writer is not None:
+            # Shallow copy, the caller keeps reading the data after this call
+            self.background_writer.put(dict(data), index)
+        else:
+            self._write(data, index)
 
     def close(self):
-        self.sink.close()
+        # The shard and its index are always finalized, a failure of the queued
+        # samples is raised afterwards
+        try:
+            if self.background_writer is not None:
+                try:
+                    self.background_writer.close()
+                finally:
+                    self.background_writer = None
+            if self.encoder_pool is not None:
+                for ready_sample in self.encoder_pool.flush():
+                    self.sink.write(ready_sample)
+        finally:
+            if self.encoder_pool is not None:
+                self.encoder_pool.close()
+                self.encoder_pool = None
+            if self.sink is not None:
+                self.sink.close()
+                self.sink = None